@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+import argparse, io, os, tempfile, time
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, ImageFilter
+
+from downloadbench import start_server
+from orpheus.artwork import ArtworkCache
+from utils.utils import download_file, resize_artwork
+
+def make_cover(seed, size=3000):
+    # A noisy gradient, which compresses about as well as a photo
+    noise = [Image.effect_noise((size // 4, size // 4), 40 + seed * 7 + i).resize((size, size)) for i in range(3)]
+    gradient = Image.linear_gradient('L').resize((size, size))
+    channels = [Image.blend(gradient.rotate(90 * i), channel, 0.5).filter(ImageFilter.GaussianBlur(1)) for i, channel in enumerate(noise)]
+    output = io.BytesIO()
+    Image.merge('RGB', channels).save(output, 'jpeg', quality=95)
+    return output.getvalue()
+
+def download_and_resize_file(url, file_location, artwork_settings):
+    # How artwork was resized before resize_artwork, downloaded to a file that is then decoded in full
+    download_file(url, file_location)
+    with Image.open(file_location) as im:
+        im = im.resize((artwork_settings['resolution'], artwork_settings['resolution']), Image.Resampling.BICUBIC)
+        im.save(file_location, 'jpeg', quality=90)
+
+def main():
+    parser = argparse.ArgumentParser(description='Orpheus Artwork Resize Benchmark')
+    parser.add_argument('-n', '--covers', type=int, default=12, help='Number of 3000px covers')
+    parser.add_argument('-r', '--resolutions', type=int, nargs='+', default=[1400, 600], help='Resolutions to resize to')
+    parser.add_argument('-p', '--processes', type=int, default=2, help='Worker processes of the pool, like covers.artwork_processes')
+    parser.add_argument('-t', '--threads', type=int, default=4, help='Threads resizing at the same time, like concurrent downloads')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp:
+        serve_directory, output_directory = os.path.join(temp, 'serve'), os.path.join(temp, 'output')
+        os.makedirs(serve_directory)
+        os.makedirs(output_directory)
+        covers = []
+        for i in range(args.covers):
+            covers.append(make_cover(i))
+            with open(os.path.join(serve_directory, f'{i}.jpg'), 'wb') as f: f.write(covers[-1])
+        print(f'{args.covers} covers of 3000px, {sum(map(len, covers)) / len(covers) / 1024**2:.2f} MiB on average, {os.cpu_count()} CPUs')
+
+        server, base_url = start_server(serve_directory)
+        # Covers are fetched through ArtworkCache.download as the Downloader does, with the disk cache disabled so every
+        # download is resized again
+        inline_cache, pool_cache = ArtworkCache(temp, 0), ArtworkCache(temp, 0, args.processes)
+        try:
+            pool_cache.download(f'{base_url}/0.jpg', os.path.join(output_directory, 'warmup.jpg'), {'should_resize': True, 'resolution': 100})  # Starts the workers
+            for resolution in args.resolutions:
+                artwork_settings = {'should_resize': True, 'resolution': resolution, 'format': 'jpeg', 'compression': 'low'}
+                paths = {'old path': lambda i, location: download_and_resize_file(f'{base_url}/{i}.jpg', location, artwork_settings),
+                    'resize_artwork': lambda i, location: resize_artwork(covers[i], artwork_settings),
+                    'ArtworkCache inline': lambda i, location: inline_cache.download(f'{base_url}/{i}.jpg', location, artwork_settings),
+                    f'ArtworkCache pool of {args.processes}': lambda i, location: pool_cache.download(f'{base_url}/{i}.jpg', location, artwork_settings)}
+                results = []
+                for name, resize in paths.items():
+                    locations = [os.path.join(output_directory, f'{resolution}-{len(results)}-{i}.jpg') for i in range(len(covers))]
+                    start = time.perf_counter()
+                    with ThreadPoolExecutor(args.threads) as executor:
+                        list(executor.map(resize, range(len(covers)), locations))
+                    results.append(f'{name} {(time.perf_counter() - start) * 1000 / len(covers):.0f} ms')
+                print(f'\tto {resolution}px: {", ".join(results)} per cover')
+        finally:
+            if pool_cache.executor: pool_cache.executor.shutdown()
+            server.kill()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+import argparse, contextlib, os, socket, subprocess, sys, tempfile, time
+
+from utils.utils import download_file, download_settings, r_session
+
+def start_server(directory):
+    # A static file server in its own process, so its CPU time isn't counted
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    server = subprocess.Popen([sys.executable, '-m', 'http.server', str(port), '--bind', '127.0.0.1', '-d', directory],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return server, f'http://127.0.0.1:{port}'
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise Exception('The file server did not start')
+
+def download_chunked(url, file_location, enable_progress_bar):
+    # How downloads were read before stream_response, 1 KiB chunks with the bar updated for each
+    from tqdm import tqdm
+    with r_session.get(url, stream=True, verify=False) as r, open(file_location, 'wb') as f:
+        total = int(r.headers['content-length'])
+        bar = tqdm(total=total, unit='B', unit_scale=True, unit_divisor=1024, miniters=1) if enable_progress_bar else None
+        for chunk in r.iter_content(chunk_size=1024):
+            if chunk:
+                f.write(chunk)
+                if bar: bar.update(len(chunk))
+        if bar: bar.close()
+
+def main():
+    parser = argparse.ArgumentParser(description='Orpheus Download CPU Time Benchmark')
+    parser.add_argument('-s', '--size', type=int, default=512, help='Size of the test file in MiB')
+    parser.add_argument('-b', '--buffer-sizes', type=int, nargs='+', default=[64, 256, 1024], help='download_buffer_size values to compare, in KiB')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp:
+        serve_directory = os.path.join(temp, 'serve')
+        os.makedirs(serve_directory)
+        with open(os.path.join(serve_directory, 'file.bin'), 'wb') as f:
+            for _ in range(args.size): f.write(os.urandom(1024**2))
+        server, base_url = start_server(serve_directory)
+        url, file_location = f'{base_url}/file.bin', os.path.join(temp, 'file.bin')
+
+        def cpu_seconds_per_gb(download, enable_progress_bar):
+            # CPU time of this process, the progress bar is drawn to nowhere
+            start = time.process_time()
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stderr(devnull):
+                download(url, file_location, enable_progress_bar)
+            seconds = time.process_time() - start
+            if os.path.getsize(file_location) != args.size * 1024**2:
+                raise Exception('Download incomplete')
+            os.remove(file_location)
+            return seconds / (args.size / 1024)
+
+        try:
+            print(f'CPU seconds per GB downloading {args.size} MiB, without and with the progress bar:')
+            results = [cpu_seconds_per_gb(download_chunked, i) for i in (False, True)]
+            print(f'\t1 KiB chunks: {results[0]:.2f}, {results[1]:.2f}')
+            for buffer_size in args.buffer_sizes:
+                download_settings['download_buffer_size'] = buffer_size
+                results = [cpu_seconds_per_gb(lambda *a: download_file(*a[:2], enable_progress_bar=a[2]), i) for i in (False, True)]
+                print(f'\t{buffer_size} KiB buffer: {results[0]:.2f}, {results[1]:.2f}')
+        finally:
+            server.kill()
+
+if __name__ == '__main__':
+    main()
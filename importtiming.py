@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+
+import argparse, os, re, statistics, subprocess, sys
+
+# Packages only needed for tagging, conversion, artwork and progress bars, which must not be imported at startup
+lazy_packages = ['PIL', 'mutagen', 'ffmpeg', 'tqdm', 'numpy']
+
+def import_times(module):
+    # Cumulative import time in microseconds of every package imported by a fresh interpreter importing module
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], capture_output=True, text=True,
+        cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stderr
+    times = {}
+    for line in output.splitlines():
+        match = re.match(r'import time:\s+\d+ \|\s+(\d+) \|( *)(\S+)', line)
+        if match: times[match.group(3)] = max(times.get(match.group(3), 0), int(match.group(1)))
+    return times
+
+def main():
+    parser = argparse.ArgumentParser(description='Orpheus Startup Import Time Benchmark')
+    parser.add_argument('-m', '--module', default='orpheus.core', help='Module to import, orpheus.core by default')
+    parser.add_argument('-r', '--runs', type=int, default=5, help='Number of runs, the median is reported')
+    parser.add_argument('-t', '--top', type=int, default=10, help='Number of slowest packages to list')
+    parser.add_argument('--max-ms', type=float, help='Fail if the median import time is above this many milliseconds')
+    args = parser.parse_args()
+
+    import_times(args.module)  # Warms up the bytecode cache
+    runs = [import_times(args.module) for _ in range(args.runs)]
+    median = lambda name: statistics.median(run.get(name, 0) for run in runs) / 1000
+
+    print(f'{args.module}: {median(args.module):.1f} ms (median of {args.runs} runs)')
+    top_level = {name for name in runs[0] if '.' not in name and name not in (args.module, 'site')}
+    for name in sorted(top_level, key=median, reverse=True)[:args.top]:
+        print(f'\t{name}: {median(name):.1f} ms')
+
+    failed = False
+    imported_lazy_packages = [i for i in lazy_packages if i in runs[0]]
+    if imported_lazy_packages:
+        print(f'Imported at startup, should be imported on first use: {", ".join(imported_lazy_packages)}')
+        failed = True
+    if args.max_ms and median(args.module) > args.max_ms:
+        print(f'Import time is above {args.max_ms} ms')
+        failed = True
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+import argparse, io, os, re, sys, tempfile, threading
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+from utils.manifests import download_manifest
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    # Static files with single Range requests answered with 206, like a CDN
+    def log_message(self, format, *args): pass
+
+    def send_head(self):
+        match = re.fullmatch(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        path = self.translate_path(self.path)
+        if not match or not os.path.isfile(path):
+            return super().send_head()
+        with open(path, 'rb') as f: data = f.read()
+        start, end = int(match.group(1)), min(int(match.group(2) or len(data) - 1), len(data) - 1)
+        self.send_response(206)
+        self.send_header('Content-Range', f'bytes {start}-{end}/{len(data)}')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        return io.BytesIO(data[start:end + 1])
+
+def segment(name, size=5000):
+    # Distinct bytes for every segment, which don't look like any container, so the stitched file is kept as it is
+    return (name.encode() + b'|') * (size // (len(name) + 1))
+
+def write(directory, name, data):
+    os.makedirs(os.path.dirname(os.path.join(directory, name)), exist_ok=True)
+    with open(os.path.join(directory, name), 'wb' if isinstance(data, bytes) else 'w') as f: f.write(data)
+
+def make_fixtures(directory):
+    # Manifest name -> the bytes its download should consist of
+    expected = {}
+
+    # DASH SegmentTemplate with a SegmentTimeline, the higher bandwidth representation is downloaded
+    for representation in ('low', 'high'):
+        write(directory, f'template/{representation}/init.mp4', segment(f'{representation}-init'))
+        for number in range(1, 5): write(directory, f'template/{representation}/{number:03d}.m4s', segment(f'{representation}-{number}'))
+    write(directory, 'template/manifest.mpd', '''<?xml version="1.0"?>
+<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" type="static" mediaPresentationDuration="PT8S">
+  <Period>
+    <AdaptationSet contentType="audio" mimeType="audio/mp4">
+      <SegmentTemplate timescale="1000" initialization="$RepresentationID$/init.mp4" media="$RepresentationID$/$Number%03d$.m4s" startNumber="1">
+        <SegmentTimeline><S t="0" d="2000" r="2"/><S d="2000"/></SegmentTimeline>
+      </SegmentTemplate>
+      <Representation id="low" bandwidth="96000"/>
+      <Representation id="high" bandwidth="320000"/>
+    </AdaptationSet>
+  </Period>
+</MPD>''')
+    expected['template/manifest.mpd'] = segment('high-init') + b''.join(segment(f'high-{i}') for i in range(1, 5))
+
+    # DASH SegmentList of byte ranges in a single file, with a BaseURL
+    media = segment('list-init', 700) + b''.join(segment(f'list-{i}', 1200) for i in range(3))
+    write(directory, 'list/media/track.mp4', media)
+    init_size, size = len(segment('list-init', 700)), len(segment('list-0', 1200))
+    ranges = ''.join(f'<SegmentURL mediaRange="{init_size + i * size}-{init_size + (i + 1) * size - 1}"/>' for i in range(3))
+    write(directory, 'list/manifest.mpd', f'''<?xml version="1.0"?>
+<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" type="static" mediaPresentationDuration="PT6S">
+  <BaseURL>media/</BaseURL>
+  <Period>
+    <AdaptationSet mimeType="audio/mp4">
+      <Representation id="1" bandwidth="128000">
+        <BaseURL>track.mp4</BaseURL>
+        <SegmentList><Initialization range="0-{init_size - 1}"/>{ranges}</SegmentList>
+      </Representation>
+    </AdaptationSet>
+  </Period>
+</MPD>''')
+    expected['list/manifest.mpd'] = media
+
+    # HLS variant playlist whose best variant has an init section and byte ranges, with and without an offset
+    media = segment('hls-init', 600) + b''.join(segment(f'hls-{i}', 1000) for i in range(3))
+    init_size, size = len(segment('hls-init', 600)), len(segment('hls-0', 1000))
+    write(directory, 'hls/high/track.mp4', media)
+    write(directory, 'hls/low/track.mp4', segment('wrong'))
+    write(directory, 'hls/master.m3u8', '#EXTM3U\n#EXT-X-STREAM-INF:BANDWIDTH=96000\nlow/playlist.m3u8\n'
+        '#EXT-X-STREAM-INF:BANDWIDTH=320000\nhigh/playlist.m3u8\n')
+    write(directory, 'hls/low/playlist.m3u8', '#EXTM3U\n#EXT-X-TARGETDURATION:2\n#EXTINF:2,\ntrack.mp4\n#EXT-X-ENDLIST\n')
+    write(directory, 'hls/high/playlist.m3u8', f'#EXTM3U\n#EXT-X-VERSION:7\n#EXT-X-TARGETDURATION:2\n'
+        f'#EXT-X-MAP:URI="track.mp4",BYTERANGE="{init_size}@0"\n'
+        f'#EXTINF:2,\n#EXT-X-BYTERANGE:{size}@{init_size}\ntrack.mp4\n'
+        f'#EXTINF:2,\n#EXT-X-BYTERANGE:{size}\ntrack.mp4\n'
+        f'#EXTINF:2,\n#EXT-X-BYTERANGE:{size}\ntrack.mp4\n#EXT-X-ENDLIST\n')
+    expected['hls/master.m3u8'] = media
+    return expected
+
+def main():
+    parser = argparse.ArgumentParser(description='Orpheus DASH and HLS Download Testing Tool')
+    parser.add_argument('-k', '--keep', action='store_true', help='Keep the fixtures and downloads, and print where they are')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp() if args.keep else None
+    with tempfile.TemporaryDirectory() as temp:
+        directory = directory or temp
+        serve_directory = os.path.join(directory, 'serve')
+        expected = make_fixtures(serve_directory)
+        server = ThreadingHTTPServer(('127.0.0.1', 0), partial(RangeRequestHandler, directory=serve_directory))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        failed = False
+        for name, data in expected.items():
+            # Saved as .ts, which is never remuxed, so the stitched segments can be compared byte for byte
+            file_location = os.path.join(directory, name.replace('/', '_') + '.ts')
+            try:
+                download_manifest(f'http://127.0.0.1:{server.server_address[1]}/{name}', file_location)
+                with open(file_location, 'rb') as f:
+                    result = 'ok' if f.read() == data else 'stitched file differs'
+            except Exception as e:
+                result = f'failed: {e!r}'
+            failed |= result != 'ok'
+            print(f'{name}: {result}')
+        server.shutdown()
+        if args.keep: print(f'Kept in {directory}')
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
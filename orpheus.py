@@ -1,10 +1,12 @@
 #!/usr/bin/env python3
 
 import argparse
-import re
-from urllib.parse import urlparse
+import atexit
 
+from orpheus.archive import DownloadArchive
 from orpheus.core import *
+from orpheus.dispatcher import URLDispatcher
+from orpheus.jobs import JobQueue
 from orpheus.music_downloader import beauty_format_seconds
 
 
@@ -23,7 +25,7 @@ def main():
     
     help_ = 'Use "settings [option]" for orpheus controls (coreupdate, fullupdate, modinstall), "settings [module]' \
            '[option]" for module specific options (update, test, setup), searching by "[search/luckysearch] [module]' \
-           '[track/artist/playlist/album] [query]", or just putting in urls. (you may need to wrap the URLs in double' \
+           '[track/artist/playlist/album] [query]", "serve" to accept jobs over a local HTTP API, or just putting in urls. (you may need to wrap the URLs in double' \
            'quotes if you have issues downloading)'
     parser = argparse.ArgumentParser(description='Orpheus: modular music archival')
     parser.add_argument('-p', '--private', action='store_true', help=argparse.SUPPRESS)
@@ -32,15 +34,34 @@ def main():
     parser.add_argument('-cv', '--covers', default='default', help='Override module to get covers from')
     parser.add_argument('-cr', '--credits', default='default', help='Override module to get credits from')
     parser.add_argument('-sd', '--separatedownload', default='default', help='Select a different module that will download the playlist instead of the main module. Only for playlists.')
+    parser.add_argument('-nc', '--nocache', action='store_true', help='Fetch metadata from the modules again instead of using the metadata cache')
+    parser.add_argument('-ra', '--rebuildarchive', action='store_true', help='Reconcile the download archive with the files in the download path, adding tagged files it lacks, then exit')
+    parser.add_argument('-rf', '--retry-failed', action='store_true', help='Run the failed jobs of earlier runs again, along with any links given')
+    parser.add_argument('-re', '--resume', action='store_true', help='Run the unfinished jobs of interrupted runs, along with any links given')
+    parser.add_argument('-js', '--jobs', action='store_true', help='Show the state of the download job queue, then exit')
+    parser.add_argument('--timing', action='store_true', help='Print how long startup and importing each module took when exiting')
     parser.add_argument('arguments', nargs='*', help=help_)
     args = parser.parse_args()
 
-    orpheus = Orpheus(args.private)
-    if not args.arguments:
+    orpheus = Orpheus(args.private, args.nocache)
+    if args.timing: atexit.register(orpheus.print_timings)
+    if args.rebuildarchive:
+        path = args.output if args.output else orpheus.settings['global']['general']['download_path']
+        kept, moved, removed, added = DownloadArchive(os.path.join(orpheus.data_folder_base, 'download_archive.db')).rebuild(path)
+        print(f'Download archive rebuilt: {kept} tracks kept, {moved} found at a new location, {removed} removed, {added} added from their tags')
+        return
+    if args.jobs:
+        jobs, tracks, failed_jobs = JobQueue(os.path.join(orpheus.data_folder_base, 'jobs.db')).status()
+        print('Jobs: ' + (', '.join(f'{count} {state}' for state, count in jobs.items()) or 'none'))
+        print('Tracks: ' + (', '.join(f'{count} {state}' for state, count in tracks.items()) or 'none'))
+        for job in failed_jobs:
+            print(f'\tFailed: {job["service"]} {job["media_type"]} {job["media_id"]}: {job["error"]}')
+        return
+    if not args.arguments and not args.retry_failed and not args.resume:
         parser.print_help()
         exit()
 
-    orpheus_mode = args.arguments[0].lower()
+    orpheus_mode = args.arguments[0].lower() if args.arguments else ''
     if orpheus_mode == 'settings': # These should call functions in a separate py file, that does not yet exist
         setting = args.arguments[1].lower()
         if setting == 'refresh':
@@ -93,6 +114,9 @@ def main():
                 raise Exception(f'Unknown option {option}, choose add/delete/list/test')
         else:
             raise Exception(f'Unknown module {module}') # TODO: replace with InvalidModuleError
+    elif orpheus_mode == 'serve':
+        from orpheus.server import serve  # Only needed in this mode
+        serve(orpheus, args.resume)
     else:
         path = args.output if args.output else orpheus.settings['global']['general']['download_path']
         if path[-1] == '/': path = path[:-1]  # removes '/' from end if it exists
@@ -162,46 +186,17 @@ def main():
                 print(f'Download must be done as orpheus.py [download] [module] [{media_types}] [media ID 1] [media ID 2] ...')
                 exit() # TODO: replace with InvalidInput
         else:  # if no specific modes are detected, parse as urls, but first try loading as a list of URLs
-            arguments = tuple(open(args.arguments[0], 'r')) if len(args.arguments) == 1 and os.path.exists(args.arguments[0]) else args.arguments
-            media_to_download = {}
-            for link in arguments:
-                if link.startswith('http'):
-                    url = urlparse(link)
-                    components = url.path.split('/')
-
-                    service_name = None
-                    for i in orpheus.module_netloc_constants:
-                        if re.findall(i, url.netloc): service_name = orpheus.module_netloc_constants[i]
-                    if not service_name:
-                        raise Exception(f'URL location "{url.netloc}" is not found in modules!')
-                    if service_name not in media_to_download: media_to_download[service_name] = []
-
-                    if orpheus.module_settings[service_name].url_decoding is ManualEnum.manual:
-                        module = orpheus.load_module(service_name)
-                        media_to_download[service_name].append(module.custom_url_parse(link))
-                    else:
-                        if not components or len(components) <= 2:
-                            print(f'\tInvalid URL: "{link}"')
-                            exit() # TODO: replace with InvalidInput
-                        
-                        url_constants = orpheus.module_settings[service_name].url_constants
-                        if not url_constants:
-                            url_constants = {
-                                'track': DownloadTypeEnum.track,
-                                'album': DownloadTypeEnum.album,
-                                'playlist': DownloadTypeEnum.playlist,
-                                'artist': DownloadTypeEnum.artist
-                            }
-
-                        type_matches = [media_type for url_check, media_type in url_constants.items() if url_check in components]
-
-                        if not type_matches:
-                            print(f'Invalid URL: "{link}"')
-                            exit()
-
-                        media_to_download[service_name].append(MediaIdentification(media_type=type_matches[-1], media_id=components[-1]))
-                else:
-                    raise Exception(f'Invalid argument: "{link}"')
+            dispatcher = URLDispatcher(orpheus.module_netloc_constants, orpheus.module_settings, orpheus.load_module)
+            if len(args.arguments) == 1 and os.path.exists(args.arguments[0]):
+                with open(args.arguments[0], 'r') as f:  # Read line by line, link lists can be long
+                    media_to_download, rejected = dispatcher.dispatch(f)
+            else:
+                media_to_download, rejected = dispatcher.dispatch(args.arguments)
+            if rejected:
+                print(f'{len(rejected)} links were skipped:')
+                for position, link, reason in rejected:
+                    print(f'\t{position}: {reason}')
+                print()
 
         # Prepare the third-party modules similar to above
         tpm = {ModuleModes.covers: '', ModuleModes.lyrics: '', ModuleModes.credits: ''}
@@ -214,10 +209,10 @@ def main():
             tpm[i] = moduleselected
         sdm = args.separatedownload.lower()
 
-        if not media_to_download:
+        if not media_to_download and not args.retry_failed and not args.resume:
             print('No links given')
 
-        orpheus_core_download(orpheus, media_to_download, tpm, sdm, path)
+        orpheus_core_download(orpheus, media_to_download, tpm, sdm, path, args.retry_failed, args.resume)
 
 
 if __name__ == "__main__":
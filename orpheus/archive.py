@@ -0,0 +1,114 @@
+import json, os, sqlite3, threading, time
+
+archive_tag = 'ORPHEUSDL_ID'  # Tag holding "service:codec:track ID" of files downloaded with the archive enabled
+
+
+def read_archive_tag(location):
+    # The service, codec and track ID, title, artist and duration of a file tagged with its archive ID, otherwise None
+    import mutagen  # Imported on first use, like in tagging
+    from mutagen.id3 import ID3, Frame
+    from mutagen.mp4 import MP4Tags
+    try:
+        audio = mutagen.File(location)
+        if audio is None or audio.tags is None: return None
+        value = audio.tags.get(f'TXXX:{archive_tag}') or audio.tags.get(f'----:com.apple.iTunes:{archive_tag}') \
+            if isinstance(audio.tags, (ID3, MP4Tags)) else audio.tags.get(archive_tag)
+        if not value: return None
+        value = value.text[0] if isinstance(value, Frame) else value[0]
+        service, codec, track_id = (value.decode() if isinstance(value, bytes) else value).split(':', 2)
+        easy_tags = mutagen.File(location, easy=True).tags
+    except (mutagen.MutagenError, OSError, ValueError):
+        return None
+    duration = int(audio.info.length) if getattr(audio.info, 'length', None) else None
+    return service, codec, track_id, (easy_tags.get('title') or [None])[0], (easy_tags.get('artist') or [None])[0], duration
+
+
+class DownloadArchive:
+    # Every track downloaded (or found on disk) by service and ID, with where it was saved, so later runs can skip it
+    # before requesting any metadata. Albums are recorded once all their tracks are, to skip them as a whole
+    def __init__(self, location):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(location, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS downloads (
+            service TEXT NOT NULL, media_type TEXT NOT NULL, media_id TEXT NOT NULL, path TEXT NOT NULL, codec TEXT,
+            size INTEGER, timestamp REAL NOT NULL, name TEXT, artist TEXT, duration INTEGER, tracks TEXT,
+            PRIMARY KEY (service, media_type, media_id))''')
+        self.connection.commit()
+
+    def _set(self, service, media_type, media_id, path, codec=None, size=None, name=None, artist=None, duration=None, tracks=None):
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO downloads VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (service, media_type, str(media_id), path, codec, size, time.time(), name, artist, duration, tracks))
+
+    def add_track(self, service, track_id, path, codec, name, artist, duration):
+        self._set(service, 'track', track_id, path, codec, os.path.getsize(path), name, artist, duration)
+
+    def add_album(self, service, album_id, path, track_ids):
+        self._set(service, 'album', album_id, path, tracks=json.dumps([str(i) for i in track_ids]))
+
+    def get_tracks(self, service, track_ids) -> dict:
+        # Track ID -> row of the archived tracks among track_ids whose file still exists
+        track_ids, rows = [str(i) for i in track_ids], {}
+        with self.lock:
+            for i in range(0, len(track_ids), 500):  # SQLite limits the number of parameters
+                batch = track_ids[i:i + 500]
+                rows.update((row['media_id'], row) for row in self.connection.execute(
+                    f'SELECT * FROM downloads WHERE service = ? AND media_type = ? AND media_id IN ({",".join("?" * len(batch))})',
+                    (service, 'track', *batch)))
+        return {i: rows[i] for i in track_ids if i in rows and os.path.isfile(rows[i]['path'])}
+
+    def get_track(self, service, track_id):
+        return self.get_tracks(service, [track_id]).get(str(track_id))
+
+    def get_album_tracks(self, service, album_id):
+        # The album's track IDs if it was completely downloaded and all its tracks still exist, otherwise None
+        with self.lock:
+            row = self.connection.execute('SELECT tracks FROM downloads WHERE service = ? AND media_type = ? AND media_id = ?',
+                (service, 'album', str(album_id))).fetchone()
+        if not row: return None
+        track_ids = json.loads(row['tracks'])
+        return track_ids if len(self.get_tracks(service, track_ids)) == len(track_ids) else None
+
+    def rebuild(self, library_path):
+        # Reconciles the archive with a scan of the library: tracks that were moved within it are found again by file
+        # name and size, tracks that are gone are removed. Files carrying an archive ID tag that the archive doesn't
+        # know are added, so a lost archive can be rebuilt. Albums aren't, they are recorded again on their next
+        # download. Returns the number of tracks kept, moved, removed and added
+        library, locations = {}, []
+        for root, _, files in os.walk(library_path):
+            for file in files:
+                location = os.path.join(root, file).replace('\\', '/')
+                library.setdefault((file, os.path.getsize(location)), location)
+                locations.append(location)
+
+        kept, moved, removed = 0, 0, 0
+        with self.lock, self.connection:
+            rows = self.connection.execute('SELECT * FROM downloads WHERE media_type = ?', ('track',)).fetchall()
+            for row in rows:
+                key = (row['service'], row['media_type'], row['media_id'])
+                if os.path.isfile(row['path']):
+                    kept += 1
+                    self.connection.execute('UPDATE downloads SET size = ? WHERE service = ? AND media_type = ? AND media_id = ?', (os.path.getsize(row['path']), *key))
+                elif (os.path.basename(row['path']), row['size']) in library:
+                    moved += 1
+                    self.connection.execute('UPDATE downloads SET path = ? WHERE service = ? AND media_type = ? AND media_id = ?', (library[(os.path.basename(row['path']), row['size'])], *key))
+                else:
+                    removed += 1
+                    self.connection.execute('DELETE FROM downloads WHERE service = ? AND media_type = ? AND media_id = ?', key)
+            known = {row[0] for row in self.connection.execute('SELECT path FROM downloads WHERE media_type = ?', ('track',))}
+
+        added = 0
+        audio_extensions = {'.flac', '.m4a', '.mp3', '.ogg', '.opus'}
+        for location in locations:
+            if location in known or os.path.splitext(location)[1].lower() not in audio_extensions: continue
+            track = read_archive_tag(location)
+            if not track: continue
+            service, codec, track_id, name, artist, duration = track
+            with self.lock:
+                exists = self.connection.execute('SELECT 1 FROM downloads WHERE service = ? AND media_type = ? AND media_id = ?',
+                    (service, 'track', track_id)).fetchone()
+            if exists: continue
+            self._set(service, 'track', track_id, location, codec, os.path.getsize(location), name, artist, duration)
+            added += 1
+        return kept, moved, removed, added
@@ -0,0 +1,137 @@
+import hashlib, json, multiprocessing, os, shutil, sqlite3, threading
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+from utils.utils import download_file, create_temp_filename, silentremove, resize_artwork, r_session, download_timeout
+
+
+class ArtworkCache:
+    # Stores downloaded (and resized) artwork on disk, keyed by the URL and the resize settings, so covers shared by
+    # every track of an album or seen on a previous run are only fetched once. Least recently used files are evicted
+    # once the cache grows past max_size MiB, 0 disables the cache. Artwork that needs resizing is processed in memory
+    # by a pool of worker processes, so decoding large covers doesn't hold up the downloading threads
+    def __init__(self, location, max_size, processes=0):
+        self.location, self.max_size = location, max_size * 1024**2
+        self.size = None  # Total size of the cache, counted on first use
+        self.lock, self.url_locks = threading.Lock(), {}
+        self.processes, self.executor = processes, None
+
+    def _key(self, url, artwork_settings):
+        # The resize settings only matter when the artwork is resized
+        artwork_settings = artwork_settings if artwork_settings and artwork_settings.get('should_resize') else {}
+        return hashlib.sha256(json.dumps([url, artwork_settings], sort_keys=True).encode()).hexdigest()
+
+    def _url_lock(self, key):
+        with self.lock:
+            return self.url_locks.setdefault(key, threading.Lock())
+
+    def _cached_files(self):
+        for directory in os.scandir(self.location):
+            if directory.is_dir():
+                yield from (i for i in os.scandir(directory.path) if i.is_file() and not i.name.endswith('.part') and not i.name.endswith('.json'))
+
+    def _add(self, cached_location):
+        with self.lock:
+            if self.size is None:
+                self.size = sum(i.stat().st_size for i in self._cached_files())
+            else:
+                self.size += os.path.getsize(cached_location)
+            if self.size <= self.max_size: return
+
+            # Evict down to 90% of the cap, so not every new cover triggers another scan
+            for entry in sorted(self._cached_files(), key=lambda i: i.stat().st_mtime):
+                if self.size <= self.max_size * 0.9: break
+                if entry.path == cached_location: continue
+                size = entry.stat().st_size
+                silentremove(entry.path)
+                self.size -= size
+
+    def _resize(self, data, artwork_settings):
+        if not self.processes:
+            return resize_artwork(data, artwork_settings)
+        with self.lock:
+            if not self.executor:  # Spawned rather than forked, forking a process with running threads isn't safe
+                self.executor = ProcessPoolExecutor(self.processes, mp_context=multiprocessing.get_context('spawn'))
+        return self.executor.submit(resize_artwork, data, artwork_settings).result()
+
+    def _fetch(self, url, file_location, artwork_settings):
+        if not artwork_settings or not artwork_settings.get('should_resize'):
+            return download_file(url, file_location)
+
+        response = r_session.get(url, verify=False, timeout=download_timeout())
+        if response.status_code != 200:
+            raise Exception(f'Artwork download failed with status {response.status_code}')
+        data = self._resize(response.content, artwork_settings)
+        with open(file_location + '.part', 'wb') as f:
+            f.write(data)
+        os.replace(file_location + '.part', file_location)
+
+    def download(self, url, file_location, artwork_settings=None):
+        if os.path.isfile(file_location):
+            return None
+        if not self.max_size:
+            return self._fetch(url, file_location, artwork_settings)
+
+        key = self._key(url, artwork_settings)
+        cached_location = os.path.join(self.location, key[:2], key)
+        with self._url_lock(key):
+            if not os.path.isfile(cached_location):
+                os.makedirs(os.path.dirname(cached_location), exist_ok=True)
+                self._fetch(url, cached_location, artwork_settings)
+                self._add(cached_location)
+            with self.lock:  # Eviction can't remove it while it's copied
+                os.utime(cached_location)  # Marks it as recently used
+                shutil.copyfile(cached_location, file_location)
+
+    def download_to_temp(self, url, artwork_settings=None):
+        location = create_temp_filename()
+        self.download(url, location, artwork_settings)
+        return location
+
+
+_dct_size = 32
+
+@lru_cache(maxsize=None)
+def _dct_matrix():
+    # DCT-II basis for the 32x32 greyscale thumbnail perceptual hashes are computed from
+    import numpy as np
+    return np.cos(np.pi * np.outer(np.arange(_dct_size), 2 * np.arange(_dct_size) + 1) / (2 * _dct_size))
+
+def perceptual_hash(image_location) -> int:
+    # 64 bit pHash: one bit per low frequency DCT coefficient, set when it's above their median. Similar looking images
+    # differ in few bits regardless of their resolution or compression. numpy and PIL are only imported once needed
+    import numpy as np
+    from PIL import Image
+    with Image.open(image_location) as im:
+        im.draft('L', (_dct_size * 2, _dct_size * 2))
+        pixels = np.asarray(im.convert('L').resize((_dct_size, _dct_size), Image.Resampling.BICUBIC), dtype=np.float64)
+    dct_matrix = _dct_matrix()
+    low_frequencies = (dct_matrix @ pixels @ dct_matrix.T)[:8, :8].flatten()
+    bits = low_frequencies > np.median(low_frequencies[1:])  # The DC term is just the average brightness
+    return int(np.packbits(bits).view('>u8')[0])
+
+def hash_distance(hash_1: int, hash_2: int) -> int:
+    return bin(hash_1 ^ hash_2).count('1')
+
+
+class CoverHashIndex:
+    # Perceptual hashes of covers by URL, kept in an SQLite database so covers matched before aren't downloaded again.
+    # The database is only opened, and created, the first time a cover is compared
+    def __init__(self, location):
+        self.location, self.connection, self.lock = location, None, threading.Lock()
+
+    def _connect(self):
+        if not self.connection:
+            self.connection = sqlite3.connect(self.location, check_same_thread=False)
+            self.connection.execute('CREATE TABLE IF NOT EXISTS cover_hashes (url TEXT PRIMARY KEY, hash TEXT NOT NULL)')
+            self.connection.commit()
+        return self.connection
+
+    def get(self, url):
+        with self.lock:
+            row = self._connect().execute('SELECT hash FROM cover_hashes WHERE url = ?', (url,)).fetchone()
+        return int(row[0], 16) if row else None  # Stored as hex, SQLite integers are signed
+
+    def set(self, url, image_hash: int):
+        with self.lock, self._connect():
+            self.connection.execute('INSERT OR REPLACE INTO cover_hashes VALUES (?, ?)', (url, f'{image_hash:016x}'))
@@ -0,0 +1,96 @@
+import copy, json, pickle, sqlite3, threading, time
+
+
+class PersistentCache:
+    # Pickled values in an SQLite table, stored with the time they were written so reads can apply a TTL
+    def __init__(self, location, table):
+        self.table, self.lock = table, threading.Lock()
+        self.connection = sqlite3.connect(location, check_same_thread=False)
+        self.connection.execute(f'CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value BLOB NOT NULL, created REAL NOT NULL)')
+        self.connection.commit()
+
+    def get(self, key, ttl):
+        # Returns None if the key is missing or older than ttl seconds
+        with self.lock:
+            row = self.connection.execute(f'SELECT value, created FROM {self.table} WHERE key = ?', (key,)).fetchone()
+        return pickle.loads(row[0]) if row and time.time() - row[1] < ttl else None
+
+    def set(self, key, value):
+        with self.lock, self.connection:
+            self.connection.execute(f'INSERT OR REPLACE INTO {self.table} VALUES (?, ?, ?)', (key, pickle.dumps(value), time.time()))
+
+
+class MemoryCache:
+    # Values kept for the jobs running, cleared by run_job once none are left. Entries also expire after max_age
+    # seconds, so a server that never runs out of jobs doesn't keep them, or the tokens in them, forever
+    max_age = 3600
+
+    def __init__(self):
+        self.entries, self.lock = {}, threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and time.monotonic() - entry[0] < self.max_age: return entry[1]
+            self.entries.pop(key, None)
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = time.monotonic(), value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class SearchCache:
+    # Remembers search results by module, query type, query and ISRC, so the covers, lyrics and credits lookups of a
+    # track search each module once per job. With a ttl in hours, results are also kept on disk for later runs
+    def __init__(self, location, ttl=0):
+        self.memory = MemoryCache()
+        self.ttl = ttl * 3600
+        self.persistent = PersistentCache(location, 'searches') if ttl else None
+
+    def get(self, module_name, query_type, query, isrc, search_function):
+        key = json.dumps([module_name, query_type.name, query, isrc])
+        results = self.memory.get(key)
+        if results is not None: return results
+
+        results = self.persistent.get(key, self.ttl) if self.persistent else None
+        if results is None:
+            results = search_function()
+            if self.persistent: self.persistent.set(key, results)
+        self.memory.set(key, results)
+        return results
+
+
+class CachedModuleInterface:
+    # Wraps a loaded ModuleInterface so the info getters are only called once per job for the same arguments. With a
+    # ttl in hours set for their entity, results are also kept on disk for later runs. bypass ignores what's on disk
+    # and fetches everything again, while still storing the fresh results
+    cached_methods = {'get_track_info': 'track', 'get_album_info': 'album', 'get_playlist_info': 'playlist', 'get_artist_info': 'artist'}
+
+    def __init__(self, module, module_name, location, ttls: dict, bypass=False):
+        self.module, self.module_name, self.bypass = module, module_name, bypass
+        self.ttls = {entity: ttls.get(entity, 0) * 3600 for entity in self.cached_methods.values()}
+        self.persistent = PersistentCache(location, 'metadata') if any(self.ttls.values()) else None
+        self.memory = MemoryCache()
+
+    def __getattr__(self, name):
+        attribute = getattr(self.module, name)
+        if name in self.cached_methods:
+            return lambda *args, **kwargs: self._cached_call(name, attribute, *args, **kwargs)
+        return attribute
+
+    def _cached_call(self, name, function, *args, **kwargs):
+        # Arguments are keyed by their repr, which is stable for the IDs, enums and dataclasses modules are passed
+        key = json.dumps([self.module_name, name, args, kwargs], default=repr, sort_keys=True)
+        ttl = self.ttls[self.cached_methods[name]]
+        result = self.memory.get(key)
+        if result is None and ttl and not self.bypass:
+            result = self.persistent.get(key, ttl)
+        if result is None:
+            result = function(*args, **kwargs)
+            if ttl: self.persistent.set(key, result)
+        self.memory.set(key, result)
+        return copy.deepcopy(result)  # Callers modify the info they get, e.g. the track tags
@@ -1,6 +1,8 @@
-import importlib, json, logging, os, pickle, requests, urllib3, base64, shutil
+import copy, hashlib, importlib, json, logging, os, pickle, requests, urllib3, base64, shutil, sys, threading, time
 from datetime import datetime
 
+from orpheus.cache import CachedModuleInterface
+from orpheus.jobs import JobQueue
 from orpheus.music_downloader import Downloader
 from utils.models import *
 from utils.utils import *
@@ -29,7 +31,10 @@ def true_current_utc_timestamp():
 
 
 class Orpheus:
-    def __init__(self, private_mode=False):
+    def __init__(self, private_mode=False, bypass_cache=False):
+        startup_start = time.perf_counter()
+        self.bypass_cache, self.timings = bypass_cache, {}
+        self.module_lock = threading.RLock()  # Server workers can load modules at the same time
         self.extensions, self.extension_list, self.module_list, self.module_settings, self.module_netloc_constants, self.loaded_modules = {}, set(), set(), {}, {}, {}
 
         self.default_global_settings = {
@@ -37,11 +42,15 @@ class Orpheus:
                 "download_path": "./downloads/",
                 "download_quality": "hifi",
                 "search_limit": 10,
-                "strict_quality_download": False
+                "strict_quality_download": False,
+                "concurrent_tracks": 1,
+                "metadata_prefetch": 0
             },
             "artist_downloading":{
                 "return_credited_albums": True,
-                "separate_tracks_skip_downloaded": True
+                "separate_tracks_skip_downloaded": True,
+                "concurrent_albums": 1,
+                "concurrent_albums_per_module": {}
             },
             "formatting": {
                 "album_format": "{name}{explicit}",
@@ -75,13 +84,47 @@ class Orpheus:
                 "external_format": 'png',
                 "external_compression": "low",
                 "external_resolution": 3000,
-                "save_animated_cover": True
+                "save_animated_cover": True,
+                "artwork_processes": 2
             },
             "playlist": {
                 "save_m3u": True,
                 "paths_m3u": "absolute",
                 "extended_m3u": True
             },
+            "downloading": {
+                "segmented_download_threshold": 0,
+                "segmented_download_connections": 4,
+                "download_buffer_size": 256,
+                "segment_connections": 4,
+                "connect_timeout": 10,
+                "read_timeout": 30,
+                "stall_speed": 1,
+                "stall_time": 60,
+                "max_host_stalls": 5
+            },
+            "caching": {
+                "artwork_cache_size": 256,
+                "search_cache_ttl": 0,
+                "metadata_cache_ttl": {
+                    "track": 0,
+                    "album": 0,
+                    "playlist": 0,
+                    "artist": 0
+                }
+            },
+            "rate_limiting": {
+                "requests_per_second": 0,
+                "burst": 5,
+                "max_concurrent_streams": 0,
+                "per_module": {}
+            },
+            "server": {
+                "host": "127.0.0.1",
+                "port": 8421,
+                "workers": 2,
+                "allowed_output_paths": []
+            },
             "advanced": {
                 "advanced_login_system": False,
                 "codec_conversions": {
@@ -94,7 +137,20 @@ class Orpheus:
                     }
                 },
                 "conversion_keep_original": False,
+                "background_conversion": False,
+                "conversion_queue_size": 8,
+                "streaming_conversion": False,
+                "tag_padding": {
+                    "flac": "auto",
+                    "m4a": 0,
+                    "mp3": "auto",
+                    "ogg": "auto",
+                    "opus": "auto"
+                },
                 "cover_variance_threshold": 8,
+                "cover_hash_threshold": 10,
+                "cover_rms_check": False,
+                "download_archive": False,
                 "debug_mode": False,
                 "disable_subscription_checks": False,
                 "enable_undesirable_conversions": False,
@@ -112,7 +168,8 @@ class Orpheus:
         self.session_storage_location = os.path.join(self.data_folder_base, 'loginstorage.bin')
 
         os.makedirs('config', exist_ok=True)
-        self.settings = json.loads(open(self.settings_location, 'r').read()) if os.path.exists(self.settings_location) else {}
+        self.settings_data = open(self.settings_location, 'r').read() if os.path.exists(self.settings_location) else '{}'
+        self.settings = json.loads(self.settings_data)
 
         try:
             if self.settings['global']['advanced']['debug_mode']: logging.basicConfig(level=logging.DEBUG)
@@ -137,8 +194,22 @@ class Orpheus:
             exit()
         logging.debug('Orpheus: Modules detected: ' + ", ".join(module_list))
 
+        # Module information is cached in a manifest, so only changed modules have to be imported to read it
+        manifest_location = os.path.join(self.data_folder_base, 'module_manifest.bin')
+        manifest = self._read_module_manifest(manifest_location)
+        manifest_changed = set(manifest) != set(module_list)
+        manifest = {module: manifest[module] for module in module_list if module in manifest}
+
         for module in module_list:  # Loading module information into module_settings
-            module_information: ModuleInformation = getattr(importlib.import_module(f'modules.{module}.interface'), 'module_information', None)
+            interface_stat = os.stat(f'modules/{module}/interface.py')
+            interface_signature = (interface_stat.st_mtime_ns, interface_stat.st_size)
+            if module in manifest and manifest[module][0] == interface_signature:
+                module_information: ModuleInformation = manifest[module][1]
+            else:
+                import_start = time.perf_counter()
+                module_information: ModuleInformation = getattr(importlib.import_module(f'modules.{module}.interface'), 'module_information', None)
+                self.timings[f'{module} interface import for module information'] = time.perf_counter() - import_start
+                manifest[module], manifest_changed = (interface_signature, module_information), True
             if module_information and not ModuleFlags.private in module_information.flags and not private_mode:
                 self.module_list.add(module)
                 self.module_settings[module] = module_information
@@ -146,6 +217,9 @@ class Orpheus:
             else:
                 raise Exception(f'Error loading module information from module: "{module}"') # TODO: replace with InvalidModuleError
 
+        if manifest_changed: self._write_module_manifest(manifest_location, manifest)
+        self.module_signatures = {module: manifest[module][0] for module in self.module_list}
+
         duplicates = set()
         for module in self.module_list: # Detecting duplicate url constants
             module_info: ModuleInformation = self.module_settings[module]
@@ -168,6 +242,11 @@ class Orpheus:
         if duplicates: raise Exception('Multiple modules installed that connect to the same service names: ' + ', '.join(' and '.join(duplicates)))
 
         self.update_module_storage()
+        download_settings.update(self.settings['global']['downloading'])
+        rate_limit_settings.update(self.settings['global']['rate_limiting'])
+        for container, policy in self.settings['global']['advanced']['tag_padding'].items():  # Tagging would only fail after the download
+            if container not in ContainerEnum.__members__ or not (policy == 'auto' or (type(policy) is int and policy >= 0)):
+                raise Exception(f'Invalid tag_padding "{policy}" for {container}, it must be "auto" or a number of KiB')
 
         for i in self.extension_list:
             extension_settings: ExtensionInformation = getattr(importlib.import_module(f'extensions.{i}.interface'), 'extension_settings', None)
@@ -181,14 +260,77 @@ class Orpheus:
         [self.load_module(module) for module in self.module_list if ModuleFlags.startup_load in self.module_settings[module].flags]
 
         self.module_controls = {'module_list': self.module_list, 'module_settings': self.module_settings,
-            'loaded_modules': self.loaded_modules, 'module_loader': self.load_module}
+            'loaded_modules': self.loaded_modules, 'module_loader': self.load_module, 'data_folder': self.data_folder_base}
+        self.timings['startup'] = time.perf_counter() - startup_start
+
+    @staticmethod
+    def _models_signature():
+        # Cached module information is only valid for the ModuleInformation it was created with
+        models_stat = os.stat(sys.modules[ModuleInformation.__module__].__file__)
+        return models_stat.st_mtime_ns, models_stat.st_size
+
+    def _read_module_manifest(self, manifest_location):
+        try:
+            with open(manifest_location, 'rb') as f:
+                models_signature, manifest = pickle.load(f)
+            return manifest if models_signature == self._models_signature() else {}
+        except Exception:  # Missing, outdated or unreadable manifests are just rebuilt
+            return {}
+
+    def _write_module_manifest(self, manifest_location, manifest):
+        try:
+            data = pickle.dumps((self._models_signature(), manifest))
+        except Exception:  # Module information that can't be pickled is imported every time
+            return
+        with open(manifest_location + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(manifest_location + '.tmp', manifest_location)
+
+    def _storage_fingerprint(self, settings_data):
+        # Everything update_module_storage depends on besides the sessions: the settings file, the default settings and
+        # the installed modules and extensions, identified by their interface files
+        extension_signatures = {}
+        for i in self.extension_list:
+            interface_stat = os.stat(f'extensions/{i}/interface.py')
+            extension_signatures[i] = (interface_stat.st_mtime_ns, interface_stat.st_size)
+        return hashlib.sha256(json.dumps([settings_data, self.default_global_settings, sorted(self.module_signatures.items()),
+            sorted(extension_signatures.items()), self._models_signature()]).encode()).hexdigest()
+
+    @staticmethod
+    def _bearer_expired(bearer):
+        try:
+            return json.loads(base64.b64decode(bearer.split('.')[0]))['exp'] - true_current_utc_timestamp() <= 0
+        except:
+            return False
+
+    def _sessions_up_to_date(self, sessions):
+        # Sessions only need reconciling if a module is missing from them, the login system changed or a token expired
+        if sessions.get('advancedmode') != self.settings['global']['advanced']['advanced_login_system']: return False
+        for i in self.module_list:
+            if i not in sessions.get('modules', {}): return False
+            if ModuleFlags.enable_jwt_system in self.module_settings[i].flags and \
+                    any(j.get('bearer') and self._bearer_expired(j['bearer']) for j in sessions['modules'][i]['sessions'].values()):
+                return False
+        return True
+
+    def print_timings(self):
+        print('Timings:')
+        for name, seconds in self.timings.items():
+            print(f'\t{name}: {seconds * 1000:.1f} ms')
 
     def load_module(self, module: str):
+        # Sessions the module creates while it's imported, set up and logged in are rate limited as that module
+        with self.module_lock, rate_limited_as(module.lower()):
+            return self._load_module(module)
+
+    def _load_module(self, module: str):
         module = module.lower()
         if module not in self.module_list:
             raise Exception(f'"{module}" does not exist in modules.') # TODO: replace with InvalidModuleError
         if module not in self.loaded_modules:
+            import_start = time.perf_counter()
             class_ = getattr(importlib.import_module(f'modules.{module}.interface'), 'ModuleInterface', None)
+            self.timings[f'{module} interface import'] = time.perf_counter() - import_start
             if class_:
                 class ModuleError(Exception): # TODO: get rid of this, as it is deprecated
                     def __init__(self, message):
@@ -215,7 +357,8 @@ class Orpheus:
                 )
 
                 loaded_module = class_(module_controller)
-                self.loaded_modules[module] = loaded_module
+                self.loaded_modules[module] = CachedModuleInterface(loaded_module, module, os.path.join(self.data_folder_base, 'cache.db'),
+                    self.settings['global']['caching']['metadata_cache_ttl'], self.bypass_cache)
 
                 # Check if module has settings
                 settings = self.settings['modules'][module] if module in self.settings['modules'] else {}
@@ -241,13 +384,21 @@ class Orpheus:
                 if ModuleFlags.uses_data in self.module_settings[module].flags and not os.path.exists(data_folder): os.makedirs(data_folder)
 
                 logging.debug(f'Orpheus: {module} module has been loaded')
-                return loaded_module
+                return self.loaded_modules[module]
             else:
                 raise Exception(f'Error loading module: "{module}"') # TODO: replace with InvalidModuleError
         else:
             return self.loaded_modules[module]
 
     def update_module_storage(self): # Should be refactored eventually
+        # Nothing needs to be rebuilt if neither the settings nor the modules changed since the last reconciliation
+        fingerprint_location = os.path.join(self.data_folder_base, 'storage_fingerprint')
+        session_store = get_session_store(self.session_storage_location)
+        if os.path.exists(fingerprint_location) and os.path.exists(self.session_storage_location):
+            with open(fingerprint_location, 'r') as f:
+                if f.read() == self._storage_fingerprint(self.settings_data) and self._sessions_up_to_date(session_store.get()):
+                    return
+
         ## Settings
         old_settings, new_settings, global_settings, extension_settings, module_settings, new_setting_detected = {}, {}, {}, {}, {}, False
 
@@ -305,7 +456,7 @@ class Orpheus:
         new_settings['modules'] = module_settings
 
         ## Sessions
-        sessions = pickle.load(open(self.session_storage_location, 'rb')) if os.path.exists(self.session_storage_location) else {}
+        sessions = copy.deepcopy(session_store.get()) if os.path.exists(self.session_storage_location) else {}
 
         if not ('advancedmode' in sessions and 'modules' in sessions and sessions['advancedmode'] == advanced_login_mode):
             sessions = {'advancedmode': advanced_login_mode, 'modules':{}}
@@ -337,11 +488,7 @@ class Orpheus:
                 if ModuleFlags.enable_jwt_system in self.module_settings[i].flags:
                     if 'bearer' in current_session and current_session['bearer'] and not clear_session:
                         # Clears bearer token if it's expired
-                        try:
-                            time_left_until_refresh = json.loads(base64.b64decode(current_session['bearer'].split('.')[0]))['exp'] - true_current_utc_timestamp()
-                            current_session['bearer'] = current_session['bearer'] if time_left_until_refresh > 0 else ''
-                        except:
-                            pass
+                        if self._bearer_expired(current_session['bearer']): current_session['bearer'] = ''
                     else:
                         current_session['bearer'] = ''
                         current_session['refresh'] = ''
@@ -354,61 +501,135 @@ class Orpheus:
                         if 'custom_data' in current_session and j in current_session['custom_data'] and not clear_session}
                 elif 'custom_data' in current_session: current_session.pop('custom_data')
 
-        pickle.dump({'advancedmode': advanced_login_mode, 'modules': new_module_sessions}, open(self.session_storage_location, 'wb'))
-        open(self.settings_location, 'w').write(json.dumps(new_settings, indent = 4, sort_keys = False))
+        # Files are only written if their contents changed
+        new_sessions = {'advancedmode': advanced_login_mode, 'modules': new_module_sessions}
+        if not os.path.exists(self.session_storage_location) or new_sessions != session_store.get():
+            session_store.replace(new_sessions)
+        settings_data = json.dumps(new_settings, indent = 4, sort_keys = False)
+        if settings_data != self.settings_data:
+            open(self.settings_location, 'w').write(settings_data)
+            self.settings, self.settings_data = new_settings, settings_data
 
         if new_setting_detected:
             print('New settings detected, or the configuration has been reset. Please update settings.json')
             exit()
+        with open(fingerprint_location, 'w') as f:
+            f.write(self._storage_fingerprint(settings_data))
 
 
-def orpheus_core_download(orpheus_session: Orpheus, media_to_download, third_party_modules, separate_download_module, output_path):
+def orpheus_core_download(orpheus_session: Orpheus, media_to_download, third_party_modules, separate_download_module, output_path, retry_failed=False, resume=False):
     downloader = Downloader(orpheus_session.settings['global'], orpheus_session.module_controls, oprinter, output_path)
     os.makedirs('temp', exist_ok=True)
 
+    # Everything requested is added to the job queue first. Unfinished jobs of interrupted runs are only run with resume,
+    # unless they were requested again
+    job_queue = JobQueue(os.path.join(orpheus_session.data_folder_base, 'jobs.db'))
+    options = {'third_party_modules': third_party_modules, 'separate_download_module': separate_download_module, 'output_path': output_path}
     for mainmodule, items in media_to_download.items():
         for media in items:
-            if ModuleModes.download not in orpheus_session.module_settings[mainmodule].module_supported_modes:
-                raise Exception(f'{mainmodule} does not support track downloading') # TODO: replace with ModuleDoesNotSupportAbility
-
-            # Load and prepare module
-            music = orpheus_session.load_module(mainmodule)
-            downloader.service = music
-            downloader.service_name = mainmodule
-
-            for i in third_party_modules:
-                moduleselected = third_party_modules[i]
-                if moduleselected:
-                    if moduleselected not in orpheus_session.module_list:
-                        raise Exception(f'{moduleselected} does not exist in modules.') # TODO: replace with InvalidModuleError
-                    elif i not in orpheus_session.module_settings[moduleselected].module_supported_modes:
-                        raise Exception(f'Module {moduleselected} does not support {i}') # TODO: replace with ModuleDoesNotSupportAbility
-                    else:
-                        # If all checks pass, load up the selected module
-                        orpheus_session.load_module(moduleselected)
-
-            downloader.third_party_modules = third_party_modules
-
-            mediatype = media.media_type
-            media_id = media.media_id
-
-            downloader.download_mode = mediatype
-
-            # Mode to download playlist using other service
-            if separate_download_module != 'default' and separate_download_module != mainmodule:
-                if mediatype is not DownloadTypeEnum.playlist:
-                    raise Exception('The separate download module option is only for playlists.') # TODO: replace with ModuleDoesNotSupportAbility
-                downloader.download_playlist(media_id, custom_module=separate_download_module, extra_kwargs=media.extra_kwargs)
-            else:  # Standard download modes
-                if mediatype is DownloadTypeEnum.album:
-                    downloader.download_album(media_id, extra_kwargs=media.extra_kwargs)
-                elif mediatype is DownloadTypeEnum.track:
-                    downloader.download_track(media_id, extra_kwargs=media.extra_kwargs)
-                elif mediatype is DownloadTypeEnum.playlist:
-                    downloader.download_playlist(media_id, extra_kwargs=media.extra_kwargs)
-                elif mediatype is DownloadTypeEnum.artist:
-                    downloader.download_artist(media_id, extra_kwargs=media.extra_kwargs)
-                else:
-                    raise Exception(f'\tUnknown media type "{mediatype}"')
-
-    if os.path.exists('temp'): shutil.rmtree('temp')
\ No newline at end of file
+            job_queue.add(mainmodule, media, options)
+    print_resumable_jobs(job_queue.resumable(), resume)
+    if retry_failed: print(f'Retrying {job_queue.retry_failed()} failed jobs')
+
+    failed_jobs = sum(not run_job(orpheus_session, downloader, job) for job in job_queue.claim(resume))
+    job_queue.remove_finished()
+
+    if failed_jobs: print(f'{failed_jobs} jobs failed, use --retry-failed to run them again')
+    # Other processes still working on jobs use temp as well
+    if os.path.exists('temp') and not job_queue.unfinished(): shutil.rmtree('temp')
+
+
+def print_resumable_jobs(jobs, resume):
+    # Lists the unfinished jobs of earlier runs being resumed and where they will be downloaded to, or how many are left
+    if jobs and resume:
+        print(f'Resuming {len(jobs)} unfinished jobs from earlier runs:')
+        for job in jobs:
+            print(f'\t{job.service} {job.media.media_type.name} {job.media.media_id} to {job.options["output_path"]}')
+    elif jobs:
+        print(f'{len(jobs)} unfinished jobs from earlier runs, use --resume to run them')
+
+
+running_jobs, running_jobs_lock = 0, threading.Lock()  # Jobs in run_job, across the server's workers
+
+def reset_job_state(orpheus_session: Orpheus, downloader: Downloader):
+    # State only meant to last for a job, reset once no jobs are running, so a server doesn't keep it for days
+    for module in orpheus_session.loaded_modules.values():
+        module.memory.clear()
+    downloader.search_cache.memory.clear()
+    with host_stalls_lock:
+        host_stalls.clear()
+
+
+def run_job(orpheus_session: Orpheus, downloader: Downloader, job):
+    # Downloads a claimed job and records whether it succeeded, which is returned
+    global running_jobs
+    with running_jobs_lock:
+        running_jobs += 1
+    try:
+        with rate_limited_as(job.service):
+            try:
+                download_job(orpheus_session, downloader, job)
+            finally:
+                downloader.finish_conversions()  # Tracks still converting are part of the job
+    except Exception as e:
+        if orpheus_session.settings['global']['advanced']['debug_mode']: raise
+        job.finish(str(e))
+        print(f'=== Job {job.media.media_type.name} {job.media.media_id} failed: {e} ===')
+        return False
+    finally:
+        downloader.job = None
+        with running_jobs_lock:
+            running_jobs -= 1
+            if not running_jobs: reset_job_state(orpheus_session, downloader)
+    job.finish()
+    return True
+
+
+def download_job(orpheus_session: Orpheus, downloader: Downloader, job):
+    mainmodule, media, third_party_modules = job.service, job.media, job.options['third_party_modules']
+    separate_download_module = job.options['separate_download_module']
+    if ModuleModes.download not in orpheus_session.module_settings[mainmodule].module_supported_modes:
+        raise Exception(f'{mainmodule} does not support track downloading') # TODO: replace with ModuleDoesNotSupportAbility
+
+    # Load and prepare module
+    music = orpheus_session.load_module(mainmodule)
+    downloader.service = music
+    downloader.service_name = mainmodule
+    downloader.path = job.options['output_path'] if job.options['output_path'].endswith('/') else job.options['output_path'] + '/'
+    downloader.job = job
+
+    for i in third_party_modules:
+        moduleselected = third_party_modules[i]
+        if moduleselected:
+            if moduleselected not in orpheus_session.module_list:
+                raise Exception(f'{moduleselected} does not exist in modules.') # TODO: replace with InvalidModuleError
+            elif i not in orpheus_session.module_settings[moduleselected].module_supported_modes:
+                raise Exception(f'Module {moduleselected} does not support {i}') # TODO: replace with ModuleDoesNotSupportAbility
+            else:
+                # If all checks pass, load up the selected module
+                orpheus_session.load_module(moduleselected)
+
+    downloader.third_party_modules = third_party_modules
+
+    mediatype = media.media_type
+    media_id = media.media_id
+
+    downloader.download_mode = mediatype
+
+    # Mode to download playlist using other service
+    if separate_download_module != 'default' and separate_download_module != mainmodule:
+        if mediatype is not DownloadTypeEnum.playlist:
+            raise Exception('The separate download module option is only for playlists.') # TODO: replace with ModuleDoesNotSupportAbility
+        downloader.download_playlist(media_id, custom_module=separate_download_module, extra_kwargs=media.extra_kwargs)
+    else:  # Standard download modes
+        if mediatype is DownloadTypeEnum.album:
+            downloader.download_album(media_id, extra_kwargs=media.extra_kwargs)
+        elif mediatype is DownloadTypeEnum.track:
+            if not downloader.download_track(media_id, extra_kwargs=media.extra_kwargs):
+                raise Exception('Track download failed')
+        elif mediatype is DownloadTypeEnum.playlist:
+            downloader.download_playlist(media_id, extra_kwargs=media.extra_kwargs)
+        elif mediatype is DownloadTypeEnum.artist:
+            downloader.download_artist(media_id, extra_kwargs=media.extra_kwargs)
+        else:
+            raise Exception(f'\tUnknown media type "{mediatype}"')
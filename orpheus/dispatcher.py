@@ -0,0 +1,74 @@
+import json, re
+from urllib.parse import urlparse
+
+from utils.exceptions import InvalidInput
+from utils.models import DownloadTypeEnum, ManualEnum, MediaIdentification
+
+
+default_url_constants = {
+    'track': DownloadTypeEnum.track,
+    'album': DownloadTypeEnum.album,
+    'playlist': DownloadTypeEnum.playlist,
+    'artist': DownloadTypeEnum.artist
+}
+
+
+class URLDispatcher:
+    # Sorts links by the module handling them. The netloc constants are combined into a single regex compiled once, and
+    # the module found for each host is remembered, so long link lists don't run every pattern against every line
+    def __init__(self, module_netloc_constants: dict, module_settings: dict, module_loader):
+        self.module_settings, self.module_loader = module_settings, module_loader
+        self.group_modules = {f'module{index}': module for index, module in enumerate(module_netloc_constants.values())}
+        self.netloc_regex = re.compile('|'.join(f'(?P<module{index}>{constant})' for index, constant in enumerate(module_netloc_constants))) \
+            if module_netloc_constants else None
+        self.netloc_modules = {}
+
+    def get_module(self, netloc):
+        if netloc not in self.netloc_modules:
+            match = self.netloc_regex.search(netloc) if self.netloc_regex else None
+            self.netloc_modules[netloc] = next((self.group_modules[group] for group, value in match.groupdict().items()
+                if value is not None and group in self.group_modules), None) if match else None
+        return self.netloc_modules[netloc]
+
+    def parse(self, link):
+        # Returns the module name and MediaIdentification of a link, raises InvalidInput if it can't be parsed
+        if not link.startswith('http'):
+            raise InvalidInput(f'Invalid argument: "{link}"')
+        url = urlparse(link)
+        service_name = self.get_module(url.netloc)
+        if not service_name:
+            raise InvalidInput(f'URL location "{url.netloc}" is not found in modules!')
+
+        if self.module_settings[service_name].url_decoding is ManualEnum.manual:
+            return service_name, self.module_loader(service_name).custom_url_parse(link)
+
+        components = url.path.split('/')
+        if len(components) <= 2:
+            raise InvalidInput(f'Invalid URL: "{link}"')
+        url_constants = self.module_settings[service_name].url_constants or default_url_constants
+        type_matches = [media_type for url_check, media_type in url_constants.items() if url_check in components]
+        if not type_matches:
+            raise InvalidInput(f'Invalid URL: "{link}"')
+        return service_name, MediaIdentification(media_type=type_matches[-1], media_id=components[-1])
+
+    def dispatch(self, links):
+        # Parses an iterable of links, such as an open file, one at a time. Returns the media to download by module
+        # without duplicates, and the links that were rejected as (position, link, reason), instead of stopping at them
+        media_to_download, seen, seen_links, rejected = {}, set(), set(), []
+        for position, link in enumerate(links, start=1):
+            link = link.strip()
+            if not link or link in seen_links: continue
+            seen_links.add(link)
+            try:
+                service_name, media = self.parse(link)
+            except Exception as e:  # Modules' custom_url_parse can raise anything
+                rejected.append((position, link, str(e)))
+                continue
+
+            # Different links can still point to the same media, e.g. with a query string
+            key = (service_name, media.media_type, str(media.media_id),
+                json.dumps(media.extra_kwargs, sort_keys=True, default=repr) if media.extra_kwargs else None)
+            if key not in seen:
+                seen.add(key)
+                media_to_download.setdefault(service_name, []).append(media)
+        return media_to_download, rejected
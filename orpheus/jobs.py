@@ -0,0 +1,218 @@
+import json, os, pickle, sqlite3, threading, time
+
+
+class JobQueue:
+    # Every download requested from the command line is a job, stored with the albums and tracks downloaded for it and
+    # their state (pending, running, done or failed), so a run that was interrupted can be resumed where it stopped.
+    # Each job belongs to the run that added it, its owner, which holds its byte of the lock file past the job bytes
+    # for as long as it lives. The OS releases it if the process dies, so jobs of dead runs can be told apart and are
+    # only taken over when resuming. Jobs are claimed by locking their byte of the lock file too, so two runs resuming
+    # at once don't take the same job. Within a process, the jobs claimed are tracked in claimed, as the OS locks don't
+    # keep threads of the same process apart
+    owner_lock_offset = 1 << 40
+
+    def __init__(self, location):
+        self.lock, self.claim_lock, self.claimed = threading.Lock(), threading.Lock(), set()
+        self.connection = sqlite3.connect(location, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.executescript('''CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, service TEXT NOT NULL, media_type TEXT NOT NULL, media_id TEXT NOT NULL,
+            media BLOB NOT NULL, options BLOB NOT NULL, state TEXT NOT NULL, error TEXT, created REAL NOT NULL, updated REAL NOT NULL,
+            owner INTEGER);
+            CREATE TABLE IF NOT EXISTS items (
+            job_id INTEGER NOT NULL, item_type TEXT NOT NULL, item_id TEXT NOT NULL, state TEXT NOT NULL, error TEXT,
+            path TEXT, name TEXT, artist TEXT, duration INTEGER, tracks TEXT, updated REAL NOT NULL,
+            PRIMARY KEY (job_id, item_type, item_id));
+            CREATE TABLE IF NOT EXISTS owners (id INTEGER PRIMARY KEY AUTOINCREMENT, created REAL NOT NULL)''')
+        if 'owner' not in [row['name'] for row in self.connection.execute('PRAGMA table_info(jobs)')]:  # Queues of older versions
+            self.connection.execute('ALTER TABLE jobs ADD COLUMN owner INTEGER')
+        self.lock_file = open(location + '.lock', 'a+b')
+        self.owner = None  # Registered when the first job is added or claimed
+
+    def _lock_byte(self, offset, lock=True):
+        if os.name == 'nt':
+            import msvcrt
+            self.lock_file.seek(offset)
+            try:
+                msvcrt.locking(self.lock_file.fileno(), msvcrt.LK_NBLCK if lock else msvcrt.LK_UNLCK, 1)
+            except OSError:
+                return False
+        else:
+            import fcntl
+            try:
+                fcntl.lockf(self.lock_file, (fcntl.LOCK_EX | fcntl.LOCK_NB) if lock else fcntl.LOCK_UN, 1, offset)
+            except OSError:
+                return False
+        return True
+
+    def _lock_job(self, job_id, lock=True):
+        return self._lock_byte(job_id, lock)
+
+    def _get_owner(self):
+        # This queue's owner ID, whose byte stays locked until the process exits
+        with self.lock:
+            if self.owner is None:
+                with self.connection:
+                    self.owner = self.connection.execute('INSERT INTO owners (created) VALUES (?)', (time.time(),)).lastrowid
+                self._lock_byte(self.owner_lock_offset + self.owner)
+            return self.owner
+
+    def _owner_alive(self, owner):
+        if owner is None: return False
+        if owner == self.owner: return True
+        if not self._lock_byte(self.owner_lock_offset + owner): return True
+        self._lock_byte(self.owner_lock_offset + owner, lock=False)
+        return False
+
+    def add(self, service, media, options: dict):
+        # Media an unfinished job already downloads resumes that job rather than adding another. A dead run's job is
+        # taken over with the new options, a live one's is left to it
+        owner = self._get_owner()
+        with self.lock, self.connection:
+            row = self.connection.execute('SELECT id, owner FROM jobs WHERE service = ? AND media_type = ? AND media_id = ? AND state IN (?, ?)',
+                (service, media.media_type.name, str(media.media_id), 'pending', 'running')).fetchone()
+            if row:
+                if not self._owner_alive(row['owner']):
+                    self.connection.execute('UPDATE jobs SET owner = ?, options = ?, updated = ? WHERE id = ?', (owner, pickle.dumps(options), time.time(), row['id']))
+                return row['id']
+            return self.connection.execute('INSERT INTO jobs (service, media_type, media_id, media, options, state, created, updated, owner) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (service, media.media_type.name, str(media.media_id), pickle.dumps(media), pickle.dumps(options), 'pending', time.time(), time.time(), owner)).lastrowid
+
+    def unfinished(self):
+        with self.lock:
+            return [row['id'] for row in self.connection.execute('SELECT id FROM jobs WHERE state IN (?, ?) ORDER BY id', ('pending', 'running'))]
+
+    def _claimable(self, resume):
+        # This queue's unfinished jobs, and with resume those of dead runs, oldest first
+        with self.lock:
+            rows = self.connection.execute('SELECT id, owner FROM jobs WHERE state IN (?, ?) ORDER BY id', ('pending', 'running')).fetchall()
+        return [row['id'] for row in rows if row['owner'] == self.owner or (resume and not self._owner_alive(row['owner']))]
+
+    def resumable(self):
+        # Unfinished jobs of dead runs nothing is working on, as Jobs
+        owner = self._get_owner()
+        with self.claim_lock:
+            resumable = [i for i in self._claimable(True) if i not in self.claimed and self._lock_job(i)]
+            for i in resumable: self._lock_job(i, lock=False)
+        with self.lock:
+            rows = {row['id']: row for row in self.connection.execute('SELECT * FROM jobs WHERE state IN (?, ?)', ('pending', 'running'))}
+        return [Job(self, rows[i]) for i in resumable if i in rows and rows[i]['owner'] != owner]
+
+    def _claim_next(self, attempted, resume):
+        with self.claim_lock:
+            for i in self._claimable(resume):
+                if i not in attempted and i not in self.claimed and self._lock_job(i):
+                    self.claimed.add(i)
+                    return i
+
+    def _release(self, job_id):
+        with self.claim_lock:
+            self._lock_job(job_id, lock=False)
+            self.claimed.discard(job_id)
+
+    def claim(self, resume=False):
+        # Yields this queue's unfinished jobs nothing else is working on, oldest first, each claimed until the next is
+        # taken. With resume, jobs of dead runs are taken over as well
+        owner, attempted = self._get_owner(), set()
+        while True:
+            job_id = self._claim_next(attempted, resume)
+            if job_id is None: break
+            attempted.add(job_id)
+            try:
+                with self.lock:
+                    row = self.connection.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+                if row and row['state'] in ('pending', 'running'):  # Another process may have finished it in the meantime
+                    with self.lock, self.connection:
+                        self.connection.execute('UPDATE jobs SET owner = ? WHERE id = ?', (owner, job_id))
+                    self.set_state(job_id, 'running')
+                    yield Job(self, row)
+            finally:
+                self._release(job_id)
+
+    def remove_finished(self, age=0):
+        # Removes the jobs that finished more than age seconds ago without failed albums or tracks, once no jobs are left
+        with self.lock, self.connection:
+            if not self.connection.execute('SELECT 1 FROM jobs WHERE state IN (?, ?)', ('pending', 'running')).fetchone():
+                self.connection.execute('''DELETE FROM jobs WHERE state = ? AND updated <= ? AND NOT EXISTS
+                    (SELECT 1 FROM items WHERE job_id = jobs.id AND state = ?)''', ('done', time.time() - age, 'failed'))
+                self.connection.execute('DELETE FROM items WHERE job_id NOT IN (SELECT id FROM jobs)')
+                self.connection.execute('DELETE FROM owners WHERE id != ? AND id NOT IN (SELECT owner FROM jobs WHERE owner IS NOT NULL)', (self.owner or 0,))
+
+    def set_state(self, job_id, state, error=None):
+        with self.lock, self.connection:
+            self.connection.execute('UPDATE jobs SET state = ?, error = ?, updated = ? WHERE id = ?', (state, error, time.time(), job_id))
+
+    def retry_failed(self):
+        # Failed jobs, and finished jobs with failed albums or tracks, are run again by this queue, unless a live run
+        # owns them. Returns the number of jobs
+        owner = self._get_owner()
+        with self.lock:
+            rows = self.connection.execute('''SELECT id, owner FROM jobs WHERE state = ?
+                OR (state = ? AND EXISTS (SELECT 1 FROM items WHERE job_id = jobs.id AND state = ?))''', ('failed', 'done', 'failed')).fetchall()
+        retried = [row['id'] for row in rows if not self._owner_alive(row['owner'])]
+        with self.lock, self.connection:
+            for job_id in retried:
+                self.connection.execute('UPDATE jobs SET state = ?, error = NULL, updated = ?, owner = ? WHERE id = ?', ('pending', time.time(), owner, job_id))
+                self.connection.execute('UPDATE items SET state = ?, error = NULL WHERE job_id = ? AND state IN (?, ?)', ('pending', job_id, 'failed', 'running'))
+        return len(retried)
+
+    def job_status(self, job_id):
+        # A job's row, or None if it doesn't exist, and the number of its tracks by state
+        with self.lock:
+            job = self.connection.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            tracks = dict(self.connection.execute('SELECT state, COUNT(*) FROM items WHERE job_id = ? AND item_type = ? GROUP BY state',
+                (job_id, 'track')).fetchall())
+        return job, tracks
+
+    def status(self):
+        # Number of jobs and of tracks by state, and the jobs that failed
+        with self.lock:
+            jobs = dict(self.connection.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall())
+            tracks = dict(self.connection.execute('SELECT state, COUNT(*) FROM items WHERE item_type = ? GROUP BY state', ('track',)).fetchall())
+            failed = self.connection.execute('SELECT * FROM jobs WHERE state = ? ORDER BY id', ('failed',)).fetchall()
+        return jobs, tracks, failed
+
+
+class Job:
+    # A claimed job, given to the Downloader to record the albums and tracks it downloads and skip the ones it already has
+    def __init__(self, queue: JobQueue, row):
+        self.queue, self.id, self.service = queue, row['id'], row['service']
+        self.media, self.options = pickle.loads(row['media']), pickle.loads(row['options'])
+
+    def _set_item(self, item_type, item_id, state, error=None, path=None, name=None, artist=None, duration=None, tracks=None):
+        with self.queue.lock, self.queue.connection:
+            self.queue.connection.execute('INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (self.id, item_type, str(item_id), state, error, path, name, artist, duration, tracks, time.time()))
+
+    def set_track(self, track_id, state, error=None, path=None, name=None, artist=None, duration=None):
+        self._set_item('track', track_id, state, error, path, name, artist, duration)
+
+    def set_album(self, album_id, state, track_ids=()):
+        self._set_item('album', album_id, state, tracks=json.dumps([str(i) for i in track_ids]))
+
+    def get_tracks(self, track_ids) -> dict:
+        # Track ID -> row of the tracks among track_ids this job downloaded whose file still exists
+        track_ids, rows = [str(i) for i in track_ids], {}
+        with self.queue.lock:
+            for i in range(0, len(track_ids), 500):  # SQLite limits the number of parameters
+                batch = track_ids[i:i + 500]
+                rows.update((row['item_id'], row) for row in self.queue.connection.execute(
+                    f'SELECT * FROM items WHERE job_id = ? AND item_type = ? AND state = ? AND item_id IN ({",".join("?" * len(batch))})',
+                    (self.id, 'track', 'done', *batch)))
+        return {i: rows[i] for i in track_ids if i in rows and os.path.isfile(rows[i]['path'])}
+
+    def get_track(self, track_id):
+        return self.get_tracks([track_id]).get(str(track_id))
+
+    def get_album_tracks(self, album_id):
+        # The album's downloaded track IDs if this job downloaded all of it and they are all still done, otherwise None.
+        # Albums are recorded before their background conversions finish, so one of them may have failed since
+        with self.queue.lock:
+            row = self.queue.connection.execute('SELECT tracks FROM items WHERE job_id = ? AND item_type = ? AND item_id = ? AND state = ?',
+                (self.id, 'album', str(album_id), 'done')).fetchone()
+        if not row: return None
+        track_ids = json.loads(row['tracks'])
+        return track_ids if len(self.get_tracks(track_ids)) == len(track_ids) else None
+
+    def finish(self, error=None):
+        self.queue.set_state(self.id, 'failed' if error else 'done', error)
@@ -1,17 +1,26 @@
-import logging, os, ffmpeg, sys
+import logging, os, sys, threading
 import shutil
 import unicodedata
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import asdict
+from functools import partial
+from itertools import count, islice
 from time import strftime, gmtime
 
-from ffmpeg import Error
-
-from orpheus.tagging import tag_file
+from orpheus.archive import DownloadArchive
+from orpheus.artwork import ArtworkCache, CoverHashIndex, perceptual_hash, hash_distance
+from orpheus.cache import SearchCache
 from utils.models import *
 from utils.utils import *
+from utils.manifests import download_manifest
 from utils.exceptions import *
 
 
+# Containers ffmpeg can read from a pipe, MP4 needs to seek to its index
+pipeable_containers = {ContainerEnum.flac, ContainerEnum.wav, ContainerEnum.opus, ContainerEnum.ogg, ContainerEnum.mp3}
+
+
 def beauty_format_seconds(seconds: int) -> str:
     time_data = gmtime(seconds)
 
@@ -25,6 +34,24 @@ def beauty_format_seconds(seconds: int) -> str:
     return strftime(time_format, time_data)
 
 
+def prefetch(function, items, depth: int):
+    # Yields function(item) for every item in order, while up to depth of the following items resolve in the background
+    if depth < 1:
+        for item in items: yield function(item)
+        return
+
+    items = iter(items)
+    executor = ThreadPoolExecutor(max_workers=depth)
+    pending = deque(executor.submit(function, item) for item in islice(items, depth + 1))
+    try:
+        while pending:
+            yield pending.popleft().result()
+            pending.extend(executor.submit(function, item) for item in islice(items, 1))
+    finally:
+        for future in pending: future.cancel()
+        executor.shutdown()
+
+
 class Downloader:
     def __init__(self, settings, module_controls, oprinter, path):
         self.path = path if path.endswith('/') else path + '/' 
@@ -37,21 +64,129 @@ class Downloader:
         self.loaded_modules = module_controls['loaded_modules']
         self.load_module = module_controls['module_loader']
         self.global_settings = settings
+        data_folder = module_controls['data_folder']
+        self.artwork_cache = ArtworkCache(os.path.join(data_folder, 'artwork_cache'), settings['caching']['artwork_cache_size'], settings['covers']['artwork_processes'])
+        self.cover_hash_index = CoverHashIndex(os.path.join(data_folder, 'cover_hashes.db'))
+        self.search_cache = SearchCache(os.path.join(data_folder, 'cache.db'), settings['caching']['search_cache_ttl'])
+        self.archive = DownloadArchive(os.path.join(data_folder, 'download_archive.db')) if settings['advanced']['download_archive'] else None
+        self.job = None  # The job queue's current job, set by orpheus_core_download
+
+        # Conversions and the tagging after them can run on a pool with a thread per core, each waiting on its ffmpeg
+        # process, while the next tracks download. Slots cap the tracks waiting for conversion, and so the disk used
+        if settings['advanced']['background_conversion']:
+            self.conversion_executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+            self.conversion_slots = threading.BoundedSemaphore(max(settings['advanced']['conversion_queue_size'], 1))
+        else:
+            self.conversion_executor = self.conversion_slots = None
+        self.conversions, self.conversions_lock = deque(), threading.Lock()  # (track_id, future) in the order queued
+        self.streaming_encoders = {}  # Codec -> ffmpeg encoder used when its default encoder is experimental
 
         self.oprinter = oprinter
         self.print = self.oprinter.oprint
         self.set_indent_number = self.oprinter.set_indent_number
 
+    def __copy__(self):
+        # Copies share the caches and the conversion pool, but keep track of their own conversions
+        downloader = Downloader.__new__(Downloader)
+        downloader.__dict__.update(self.__dict__)
+        downloader.conversions, downloader.conversions_lock = deque(), threading.Lock()
+        return downloader
+
+    def _submit_buffered(self, executor: ThreadPoolExecutor, function, *args, **kwargs):
+        return executor.submit(self._buffered_call, self.oprinter.indent_number, function, *args, **kwargs)
+
+    def _buffered_call(self, indent_number, function, *args, **kwargs):
+        # Runs on a worker thread, holding back the console output so the caller can replay it in order
+        self.oprinter.indent_number = indent_number
+        self.oprinter.start_buffering()
+        try:
+            result, error = function(*args, **kwargs), None
+        except BaseException as e:
+            result, error = None, e
+        return result, error, self.oprinter.end_buffering()
+
+    def _collect_buffered(self, future):
+        result, error, lines = future.result()
+        self.oprinter.write_lines(lines)
+        if error: raise error
+        return result
+
+    def _submit_conversion(self, track_id, function, *args):
+        self.conversion_slots.acquire()  # Waits while the queue is full
+        try:
+            future = self._submit_buffered(self.conversion_executor, function, *args)
+        except BaseException:
+            self.conversion_slots.release()
+            raise
+        future.add_done_callback(lambda _: self.conversion_slots.release())
+        with self.conversions_lock:
+            self.conversions.append((track_id, future))
+
+    def finish_conversions(self, wait=True, track_ids=None):
+        # Replays the output of the conversions that finished, in the order they were queued, waiting for all of them
+        # if wait. With track_ids, only the conversions of those tracks are replayed, in their order. Failed conversions
+        # are recorded as failed tracks, and their IDs returned
+        order = {track_id: index for index, track_id in enumerate(track_ids)} if track_ids is not None else None
+        failed_tracks = []
+        while True:
+            with self.conversions_lock:
+                if order is None:
+                    conversion = self.conversions[0] if self.conversions else None
+                else:
+                    conversion = min((i for i in self.conversions if i[0] in order), key=lambda i: order[i[0]], default=None)
+                if not conversion or not (wait or conversion[1].done()): return failed_tracks
+                self.conversions.remove(conversion)
+            track_id, future = conversion
+            try:
+                self._collect_buffered(future)
+            except Exception as e:
+                if self.global_settings['advanced']['debug_mode']: raise
+                self.print(f'Warning: Conversion of track {track_id} failed: {e}')
+                if self.job: self.job.set_track(track_id, 'failed', str(e))
+                failed_tracks.append(track_id)
+
+    def _get_done_tracks(self, track_ids) -> dict:
+        # Track ID -> row of the tracks in the download archive or already downloaded by the current job
+        done_tracks = self.archive.get_tracks(self.service_name, track_ids) if self.archive else {}
+        if self.job: done_tracks.update(self.job.get_tracks(track_ids))
+        return done_tracks
+
+    def _get_done_album_tracks(self, album_id):
+        # The album's track IDs if it's in the download archive or the current job already downloaded it, otherwise None
+        album_tracks = self.archive.get_album_tracks(self.service_name, album_id) if self.archive else None
+        if album_tracks is None and self.job: album_tracks = self.job.get_album_tracks(album_id)
+        return album_tracks
+
+    def _record_track(self, track_id, track_location, codec, track_info):
+        if self.archive: self.archive.add_track(self.service_name, track_id, track_location, codec.name, track_info.name, track_info.artists[0], track_info.duration)
+        if self.job: self.job.set_track(track_id, 'done', path=track_location, name=track_info.name, artist=track_info.artists[0], duration=track_info.duration)
+
+    def _get_track_info(self, track_id, extra_kwargs={}, service=None) -> TrackInfo:
+        quality_tier = QualityEnum[self.global_settings['general']['download_quality'].upper()]
+        codec_options = CodecOptions(
+            spatial_codecs = self.global_settings['codecs']['spatial_codecs'],
+            proprietary_codecs = self.global_settings['codecs']['proprietary_codecs'],
+        )
+        return (service or self.service).get_track_info(track_id, quality_tier, codec_options, **extra_kwargs)
+
+    def _prefetch_track_infos(self, track_ids: list, extra_kwargs={}, service=None, skip=()):
+        # The service is bound now, as the playlist download can switch self.service while the prefetch is running.
+        # Tracks in skip (already downloaded) get None instead of their info
+        get_track_info = partial(self._get_track_info, extra_kwargs=extra_kwargs, service=service or self.service)
+        return prefetch(lambda track_id: None if str(track_id) in skip else get_track_info(track_id), track_ids, self.global_settings['general']['metadata_prefetch'])
+
     def search_by_tags(self, module_name, track_info: TrackInfo):
-        return self.loaded_modules[module_name].search(DownloadTypeEnum.track, f'{track_info.name} {" ".join(track_info.artists)}', track_info=track_info)
+        query = f'{track_info.name} {" ".join(track_info.artists)}'
+        return self.search_cache.get(module_name, DownloadTypeEnum.track, query, track_info.tags.isrc,
+            lambda: self.loaded_modules[module_name].search(DownloadTypeEnum.track, query, track_info=track_info))
 
-    def _add_track_m3u_playlist(self, m3u_playlist: str, track_info: TrackInfo, track_location: str):
+    def _add_track_m3u_playlist(self, m3u_playlist: str, track_location: str, name: str, artist: str, duration: int = None):
         if self.global_settings['playlist']['extended_m3u']:
             with open(m3u_playlist, 'a', encoding='utf-8') as f:
                 # if no duration exists default to -1
-                duration = track_info.duration if track_info.duration else -1
+                duration = duration if duration else -1
                 # write the extended track header
-                f.write(f'#EXTINF:{duration}, {track_info.artists[0]} - {track_info.name}\n')
+                f.write(f'#EXTINF:{duration}, {artist} - {name}\n')
 
         with open(m3u_playlist, 'a', encoding='utf-8') as f:
             if self.global_settings['playlist']['paths_m3u'] == "absolute":
@@ -162,16 +297,11 @@ class Downloader:
             
             # Check each track and download if quality requirements are met
             successful_tracks = []
-            for index, track_id in enumerate(playlist_info.tracks, start=1):
+            track_infos = self._prefetch_track_infos(playlist_info.tracks, playlist_info.track_extra_kwargs, self.loaded_modules[original_service])
+            for index, (track_id, track_info) in enumerate(zip(playlist_info.tracks, track_infos), start=1):
                 self.set_indent_number(2)
                 print()
                 self.print(f'Track {index}/{number_of_tracks}', drop_level=1)
-                quality_tier = QualityEnum[self.global_settings['general']['download_quality'].upper()]
-                codec_options = CodecOptions(
-                    spatial_codecs = self.global_settings['codecs']['spatial_codecs'],
-                    proprietary_codecs = self.global_settings['codecs']['proprietary_codecs'],
-                )
-                track_info: TrackInfo = self.loaded_modules[original_service].get_track_info(track_id, quality_tier, codec_options, **playlist_info.track_extra_kwargs)
                 
                 # Check if track is unavailable first
                 if track_info.error:
@@ -199,7 +329,7 @@ class Downloader:
                         # Download playlist cover if present
                         if playlist_info.cover_url:
                             self.print('Downloading playlist cover')
-                            download_file(playlist_info.cover_url, f'{playlist_path}cover.{playlist_info.cover_type.name}', artwork_settings=self._get_artwork_settings())
+                            self.artwork_cache.download(playlist_info.cover_url, f'{playlist_path}cover.{playlist_info.cover_type.name}', artwork_settings=self._get_artwork_settings())
 
                         if playlist_info.animated_cover_url and self.global_settings['covers']['save_animated_cover']:
                             self.print('Downloading animated playlist cover')
@@ -238,7 +368,7 @@ class Downloader:
                             # Download playlist cover if present
                             if playlist_info.cover_url:
                                 self.print('Downloading playlist cover')
-                                download_file(playlist_info.cover_url, f'{playlist_path}cover.{playlist_info.cover_type.name}', artwork_settings=self._get_artwork_settings())
+                                self.artwork_cache.download(playlist_info.cover_url, f'{playlist_path}cover.{playlist_info.cover_type.name}', artwork_settings=self._get_artwork_settings())
 
                             if playlist_info.animated_cover_url and self.global_settings['covers']['save_animated_cover']:
                                 self.print('Downloading animated playlist cover')
@@ -260,26 +390,23 @@ class Downloader:
                         else:
                             m3u_playlist_path = playlist_path + playlist_info.name + '.m3u' if self.global_settings['playlist']['save_m3u'] else None
                         
-                        if self.download_track(track_id, album_location=playlist_path, track_index=len(successful_tracks)+1, number_of_tracks=number_of_tracks, indent_level=2, m3u_playlist=m3u_playlist_path, extra_kwargs=playlist_info.track_extra_kwargs):
+                        if self.download_track(track_id, album_location=playlist_path, track_index=len(successful_tracks)+1, number_of_tracks=number_of_tracks, indent_level=2, m3u_playlist=m3u_playlist_path, extra_kwargs=playlist_info.track_extra_kwargs, track_info=track_info):
                             successful_tracks.append((track_id, playlist_info.track_extra_kwargs))
                     else:
                         self.print(f'Track {track_info.name} not found, skipping')
+            track_infos.close()
         else:
             # Check each track and download if quality requirements are met
             successful_tracks = []
-            for index, track_id in enumerate(playlist_info.tracks, start=1):
+            done_tracks = self._get_done_tracks(playlist_info.tracks)
+            track_infos = self._prefetch_track_infos(playlist_info.tracks, playlist_info.track_extra_kwargs, skip=done_tracks)
+            for index, (track_id, track_info) in enumerate(zip(playlist_info.tracks, track_infos), start=1):
                 self.set_indent_number(2)
                 print()
                 self.print(f'Track {index}/{number_of_tracks}', drop_level=1)
-                quality_tier = QualityEnum[self.global_settings['general']['download_quality'].upper()]
-                codec_options = CodecOptions(
-                    spatial_codecs = self.global_settings['codecs']['spatial_codecs'],
-                    proprietary_codecs = self.global_settings['codecs']['proprietary_codecs'],
-                )
-                track_info: TrackInfo = self.service.get_track_info(track_id, quality_tier, codec_options, **playlist_info.track_extra_kwargs)
                 
-                # Check if track is unavailable first
-                if track_info.error:
+                # Check if track is unavailable first, tracks already downloaded have no info
+                if track_info and track_info.error:
                     self._log_unavailable_track(track_id, track_info, playlist_path)
                     self.print(track_info.error)
                     self.print(f'=== Track {track_id} failed ===', drop_level=1)
@@ -287,7 +414,7 @@ class Downloader:
                     continue
                 
                 # Check quality requirements
-                if not self._check_strict_quality_requirement(track_id, track_info, playlist_path):
+                if track_info and not self._check_strict_quality_requirement(track_id, track_info, playlist_path):
                     tracks_errored.add(f'{track_info.name} - {track_info.artists[0]}')
                     continue
                 
@@ -298,7 +425,7 @@ class Downloader:
                     # Download playlist cover if present
                     if playlist_info.cover_url:
                         self.print('Downloading playlist cover')
-                        download_file(playlist_info.cover_url, f'{playlist_path}cover.{playlist_info.cover_type.name}', artwork_settings=self._get_artwork_settings())
+                        self.artwork_cache.download(playlist_info.cover_url, f'{playlist_path}cover.{playlist_info.cover_type.name}', artwork_settings=self._get_artwork_settings())
 
                     if playlist_info.animated_cover_url and self.global_settings['covers']['save_animated_cover']:
                         self.print('Downloading animated playlist cover')
@@ -321,8 +448,9 @@ class Downloader:
                     m3u_playlist_path = playlist_path + playlist_info.name + '.m3u' if self.global_settings['playlist']['save_m3u'] else None
                 
                 # Download the track
-                if self.download_track(track_id, album_location=playlist_path, track_index=len(successful_tracks)+1, number_of_tracks=number_of_tracks, indent_level=2, m3u_playlist=m3u_playlist_path, extra_kwargs=playlist_info.track_extra_kwargs):
+                if self.download_track(track_id, album_location=playlist_path, track_index=len(successful_tracks)+1, number_of_tracks=number_of_tracks, indent_level=2, m3u_playlist=m3u_playlist_path, extra_kwargs=playlist_info.track_extra_kwargs, track_info=track_info):
                     successful_tracks.append(track_id)
+            track_infos.close()
 
         self.set_indent_number(1)
         if successful_tracks:
@@ -366,7 +494,7 @@ class Downloader:
     def _download_album_files(self, album_path: str, album_info: AlbumInfo):
         if album_info.cover_url:
             self.print('Downloading album cover')
-            download_file(album_info.cover_url, f'{album_path}cover.{album_info.cover_type.name}', artwork_settings=self._get_artwork_settings())
+            self.artwork_cache.download(album_info.cover_url, f'{album_path}cover.{album_info.cover_type.name}', artwork_settings=self._get_artwork_settings())
 
         if album_info.animated_cover_url and self.global_settings['covers']['save_animated_cover']:
             self.print('Downloading animated album cover')
@@ -379,6 +507,11 @@ class Downloader:
     def download_album(self, album_id, artist_name='', path=None, indent_level=1, extra_kwargs={}):
         self.set_indent_number(indent_level)
 
+        done_album = self._get_done_album_tracks(album_id)
+        if done_album is not None:
+            self.print(f'=== Album {album_id} skipped - already downloaded ===', drop_level=1)
+            return done_album
+
         album_info: AlbumInfo = self.service.get_album_info(album_id, **extra_kwargs)
         if not album_info:
             return []
@@ -411,66 +544,84 @@ class Downloader:
             self.print(f'Number of tracks: {number_of_tracks!s}')
             self.print(f'Service: {self.module_settings[self.service_name].service_name}')
 
+            # Tracks after the first successful one are downloaded on a thread pool if enabled, their output is
+            # buffered and replayed in album order. Track numbers assume the tracks still downloading will succeed
+            concurrent_tracks = self.global_settings['general']['concurrent_tracks']
+            executor = ThreadPoolExecutor(max_workers=concurrent_tracks) if concurrent_tracks > 1 else None
+            queued_tracks = deque()  # (console output, track_id, download future) in album order
+
             # Check each track and download if quality requirements are met
-            for index, track_id in enumerate(album_info.tracks, start=1):
-                self.set_indent_number(indent_level + 1)
-                print()
-                self.print(f'Track {index}/{number_of_tracks}', drop_level=1)
-                
-                # Check if track meets quality requirements before creating folder
-                quality_tier = QualityEnum[self.global_settings['general']['download_quality'].upper()]
-                codec_options = CodecOptions(
-                    spatial_codecs = self.global_settings['codecs']['spatial_codecs'],
-                    proprietary_codecs = self.global_settings['codecs']['proprietary_codecs'],
-                )
-                track_info: TrackInfo = self.service.get_track_info(track_id, quality_tier, codec_options, **album_info.track_extra_kwargs)
-                
-                # Create album path first for logging purposes
-                if album_path is None:
-                    album_path = self._create_album_location(path, album_id, album_info)
-                
-                # Check if track is unavailable first
-                if track_info.error:
-                    self._log_unavailable_track(track_id, track_info, album_path)
-                    self.print(track_info.error)
-                    self.print(f'=== Track {track_id} failed ===', drop_level=1)
-                    continue
-                
-                # Check quality requirements
-                if not self._check_strict_quality_requirement(track_id, track_info, album_path):
-                    continue  # Skip this track
-                
-                # Create folder and download covers on first successful track
-                if not successful_tracks:
-                    if album_info.booklet_url and not os.path.exists(album_path + 'Booklet.pdf'):
-                        self.print('Downloading booklet')
-                        download_file(album_info.booklet_url, album_path + 'Booklet.pdf')
-                    
-                    cover_temp_location = download_to_temp(album_info.all_track_cover_jpg_url) if album_info.all_track_cover_jpg_url else ''
+            done_tracks = self._get_done_tracks(album_info.tracks)
+            track_infos = self._prefetch_track_infos(album_info.tracks, album_info.track_extra_kwargs, skip=done_tracks)
+            try:
+                for index, (track_id, track_info) in enumerate(zip(album_info.tracks, track_infos), start=1):
+                    concurrent = bool(executor and successful_tracks)
+                    if concurrent: self.oprinter.start_buffering()
+                    download = None
+                    try:
+                        self.set_indent_number(indent_level + 1)
+                        self.oprinter.newline()
+                        self.print(f'Track {index}/{number_of_tracks}', drop_level=1)
+
+                        # Create album path first for logging purposes
+                        if album_path is None:
+                            album_path = self._create_album_location(path, album_id, album_info)
+
+                        # Check if track is unavailable first, tracks already downloaded have no info
+                        if track_info and track_info.error:
+                            self._log_unavailable_track(track_id, track_info, album_path)
+                            self.print(track_info.error)
+                            self.print(f'=== Track {track_id} failed ===', drop_level=1)
+                            continue
+
+                        # Check quality requirements
+                        if track_info and not self._check_strict_quality_requirement(track_id, track_info, album_path):
+                            continue  # Skip this track
 
-                    # Download booklet, animated album cover and album cover if present
-                    self._download_album_files(album_path, album_info)
-                else:
-                    cover_temp_location = ''
+                        # Create folder and download covers on first successful track
+                        if not successful_tracks:
+                            if album_info.booklet_url and not os.path.exists(album_path + 'Booklet.pdf'):
+                                self.print('Downloading booklet')
+                                download_file(album_info.booklet_url, album_path + 'Booklet.pdf')
 
-                # Download the track
-                if self.download_track(track_id, album_location=album_path, track_index=len(successful_tracks)+1, number_of_tracks=number_of_tracks, main_artist=artist_name, cover_temp_location=cover_temp_location, indent_level=indent_level+1, extra_kwargs=album_info.track_extra_kwargs):
-                    successful_tracks.append(track_id)
-                    if cover_temp_location: silentremove(cover_temp_location)
+                            cover_temp_location = self.artwork_cache.download_to_temp(album_info.all_track_cover_jpg_url) if album_info.all_track_cover_jpg_url else ''
 
+                            # Download booklet, animated album cover and album cover if present
+                            self._download_album_files(album_path, album_info)
+                        else:
+                            cover_temp_location = ''
+
+                        # Download the track
+                        track_index = len(successful_tracks) + sum(1 for i in queued_tracks if i[2]) + 1
+                        if concurrent:
+                            download = self._submit_buffered(executor, self.download_track, track_id, album_location=album_path, track_index=track_index, number_of_tracks=number_of_tracks, main_artist=artist_name, indent_level=indent_level+1, extra_kwargs=album_info.track_extra_kwargs, track_info=track_info)
+                        elif self.download_track(track_id, album_location=album_path, track_index=track_index, number_of_tracks=number_of_tracks, main_artist=artist_name, cover_temp_location=cover_temp_location, indent_level=indent_level+1, extra_kwargs=album_info.track_extra_kwargs, track_info=track_info):
+                            successful_tracks.append(track_id)
+                            if cover_temp_location: silentremove(cover_temp_location)
+                    finally:
+                        if concurrent:
+                            queued_tracks.append((self.oprinter.end_buffering(), track_id, download))
+                            self._flush_queued_tracks(queued_tracks, successful_tracks)
+                self._flush_queued_tracks(queued_tracks, successful_tracks, wait=True)
+            finally:
+                track_infos.close()
+                if executor: executor.shutdown()
+
+            # The album is only downloaded once its tracks converting in the background are
+            if self.conversion_executor:
+                failed_tracks = self.finish_conversions(track_ids=album_info.tracks)
+                successful_tracks = [i for i in successful_tracks if i not in failed_tracks]
             self.set_indent_number(indent_level)
+            if self.archive and len(successful_tracks) == number_of_tracks:
+                self.archive.add_album(self.service_name, album_id, album_path, album_info.tracks)
+            if self.job: self.job.set_album(album_id, 'done' if len(successful_tracks) == number_of_tracks else 'failed', successful_tracks)
             if successful_tracks:
                 self.print(f'=== Album {album_info.name} downloaded ({len(successful_tracks)}/{number_of_tracks} tracks) ===', drop_level=1)
             else:
                 self.print(f'=== Album {album_info.name} skipped - no tracks meet quality requirements ===', drop_level=1)
         elif number_of_tracks == 1:
             # For single tracks, check quality first
-            quality_tier = QualityEnum[self.global_settings['general']['download_quality'].upper()]
-            codec_options = CodecOptions(
-                spatial_codecs = self.global_settings['codecs']['spatial_codecs'],
-                proprietary_codecs = self.global_settings['codecs']['proprietary_codecs'],
-            )
-            track_info: TrackInfo = self.service.get_track_info(album_info.tracks[0], quality_tier, codec_options, **album_info.track_extra_kwargs)
+            track_info: TrackInfo = self._get_track_info(album_info.tracks[0], album_info.track_extra_kwargs)
             
             # Create album path for logging purposes
             album_path = self._create_album_location(path, album_id, album_info)
@@ -483,13 +634,59 @@ class Downloader:
                 return []
             
             if self._check_strict_quality_requirement(album_info.tracks[0], track_info, album_path):
-                return self.download_track(album_info.tracks[0], album_location=album_path, number_of_tracks=1, main_artist=artist_name, indent_level=indent_level, extra_kwargs=album_info.track_extra_kwargs)
+                downloaded = self.download_track(album_info.tracks[0], album_location=album_path, number_of_tracks=1, main_artist=artist_name, indent_level=indent_level, extra_kwargs=album_info.track_extra_kwargs, track_info=track_info)
+                if downloaded and self.conversion_executor and self.finish_conversions(track_ids=album_info.tracks): downloaded = False
+                if downloaded and self.archive: self.archive.add_album(self.service_name, album_id, album_path, album_info.tracks)
+                if self.job: self.job.set_album(album_id, 'done' if downloaded else 'failed', album_info.tracks if downloaded else [])
+                return downloaded
             else:
                 self.print(f'=== Single track album {album_info.name} skipped - does not meet quality requirements ===', drop_level=1)
                 return []
 
         return successful_tracks if 'successful_tracks' in locals() else []
 
+    def _flush_queued_tracks(self, queued_tracks: deque, successful_tracks: list, wait=False):
+        # Replays the output of finished tracks in album order, stopping at the first track still downloading
+        while queued_tracks and (wait or not queued_tracks[0][2] or queued_tracks[0][2].done()):
+            lines, track_id, download = queued_tracks.popleft()
+            self.oprinter.write_lines(lines)
+            if download and self._collect_buffered(download):
+                successful_tracks.append(track_id)
+
+    def _flush_queued_albums(self, queued_albums: deque, tracks_downloaded: list, wait=False):
+        # Replays the output of finished albums in order, stopping at the first album still downloading
+        while queued_albums and (wait or not queued_albums[0][2] or queued_albums[0][2].done()):
+            lines, album_id, download = queued_albums.popleft()
+            self.oprinter.write_lines(lines)
+            if download:
+                try:
+                    tracks_downloaded.extend(self._collect_buffered(download))
+                except Exception as e:
+                    self.print(f'Error processing album {album_id}: {str(e)}', drop_level=2)
+
+    def _skip_artist_album(self, album_info: AlbumInfo, artist_name: str) -> bool:
+        # Remove collector's editions
+        if self.global_settings['advanced'].get('remove_collectors_editions', False):
+            collectors_keywords = ['collector', 'deluxe', 'expanded', 'bonus', 'special', 'anniversary', 'remastered', 'reissue', 'limited']
+            if any(keyword in album_info.name.lower() for keyword in collectors_keywords):
+                self.print(f'Skipping collector edition: {album_info.name}', drop_level=2)
+                return True
+
+        # Remove live recordings
+        if self.global_settings['advanced'].get('remove_live_recordings', False):
+            live_keywords = ['live', 'concert', 'performance', 'stage', 'tour', 'acoustic', 'unplugged', 'mtv', 'bbc', 'radio', 'session']
+            if any(keyword in album_info.name.lower() for keyword in live_keywords):
+                self.print(f'Skipping live recording: {album_info.name}', drop_level=2)
+                return True
+
+        # Strict artist match
+        if self.global_settings['advanced'].get('strict_artist_match', False):
+            if album_info.artist.strip().lower() != artist_name.strip().lower():
+                self.print(f'Skipping different artist: {album_info.name} (by {album_info.artist})', drop_level=2)
+                return True
+
+        return False
+
     def download_artist(self, artist_id, extra_kwargs={}):
         # Get basic artist info first (just the name)
         artist_name = self.service.session.get_artist_name(artist_id) if hasattr(self.service, 'session') else None
@@ -513,22 +710,25 @@ class Downloader:
 
         # --- PROCESS ALBUMS IN BATCHES ---
         batch_size = 50  # Process 50 albums at a time
-        start = 0
         album_count = 0
         filtered_album_count = 0
         tracks_downloaded = []
-        
-        self.print('Processing albums in batches...', drop_level=1)
-        
-        while True:
-            # Get a batch of album IDs
+
+        # Albums can be downloaded concurrently, capped per module to stay below the service's rate limits. Album info
+        # and the next batch of album IDs are then fetched ahead, while the output is still printed in album order
+        artist_settings = self.global_settings['artist_downloading']
+        concurrent_albums = artist_settings['concurrent_albums_per_module'].get(self.service_name, artist_settings['concurrent_albums'])
+        executor = ThreadPoolExecutor(max_workers=concurrent_albums) if concurrent_albums > 1 else None
+        queued_albums = deque()  # (console output, album_id, download future) in album order
+
+        def get_album_ids(start):
             if hasattr(self.service, 'session'):
                 # Use direct API call for pagination
-                album_ids = self.service.session.get_artist_album_ids(
+                return self.service.session.get_artist_album_ids(
                     artist_id, 
                     start, 
                     batch_size, 
-                    self.global_settings['artist_downloading']['return_credited_albums']
+                    artist_settings['return_credited_albums']
                 )
             else:
                 # Fallback: get all albums and slice them
@@ -536,68 +736,79 @@ class Downloader:
                     artist_id, 
                     0, 
                     -1, 
-                    self.global_settings['artist_downloading']['return_credited_albums']
+                    artist_settings['return_credited_albums']
                 )
-                album_ids = all_albums[start:start + batch_size]
-            
-            # If no more albums, break
-            if not album_ids:
-                break
-                
-            album_count += len(album_ids)
-            self.print(f'Processing batch: albums {start + 1}-{start + len(album_ids)} (total found so far: {album_count})', drop_level=1)
-            
-            # Process each album in the batch
-            for album_id in album_ids:
-                try:
-                    # Get album info
-                    album_info = self.service.get_album_info(album_id)
-                    
-                    # Apply filters
-                    should_skip = False
-                    
-                    # Remove collector's editions
-                    if self.global_settings['advanced'].get('remove_collectors_editions', False):
-                        collectors_keywords = ['collector', 'deluxe', 'expanded', 'bonus', 'special', 'anniversary', 'remastered', 'reissue', 'limited']
-                        if any(keyword in album_info.name.lower() for keyword in collectors_keywords):
-                            self.print(f'Skipping collector edition: {album_info.name}', drop_level=2)
-                            should_skip = True
-                    
-                    # Remove live recordings
-                    if not should_skip and self.global_settings['advanced'].get('remove_live_recordings', False):
-                        live_keywords = ['live', 'concert', 'performance', 'stage', 'tour', 'acoustic', 'unplugged', 'mtv', 'bbc', 'radio', 'session']
-                        if any(keyword in album_info.name.lower() for keyword in live_keywords):
-                            self.print(f'Skipping live recording: {album_info.name}', drop_level=2)
-                            should_skip = True
-                    
-                    # Strict artist match
-                    if not should_skip and self.global_settings['advanced'].get('strict_artist_match', False):
-                        if album_info.artist.strip().lower() != artist_name.strip().lower():
-                            self.print(f'Skipping different artist: {album_info.name} (by {album_info.artist})', drop_level=2)
-                            should_skip = True
-                    
-                    if should_skip:
+                return all_albums[start:start + batch_size]
+
+        def get_album_info(album_id):
+            # Errors are returned, as an exception would end the prefetch of the following albums. Albums already
+            # downloaded are not requested at all
+            try:
+                if self._get_done_album_tracks(album_id) is not None:
+                    return None, None
+                return self.service.get_album_info(album_id), None
+            except Exception as e:
+                return None, e
+
+        self.print('Processing albums in batches...', drop_level=1)
+
+        batches = prefetch(get_album_ids, count(0, batch_size), 1 if executor else 0)
+        try:
+            for start, album_ids in zip(count(0, batch_size), batches):
+                # If no more albums, break
+                if not album_ids:
+                    break
+
+                album_count += len(album_ids)
+                if executor: self.oprinter.start_buffering()
+                self.print(f'Processing batch: albums {start + 1}-{start + len(album_ids)} (total found so far: {album_count})', drop_level=1)
+                if executor: queued_albums.append((self.oprinter.end_buffering(), None, None))
+
+                # Process each album in the batch
+                album_infos = prefetch(get_album_info, album_ids, concurrent_albums if executor else 0)
+                for album_id, (album_info, error) in zip(album_ids, album_infos):
+                    if executor: self.oprinter.start_buffering()
+                    download = None
+                    try:
+                        if error: raise error
+
+                        if not album_info:
+                            self.print(f'Skipping album already downloaded: {album_id}', drop_level=2)
+                            tracks_downloaded.extend(self._get_done_album_tracks(album_id) or [])
+                            continue
+
+                        # Apply filters
+                        if self._skip_artist_album(album_info, artist_name):
+                            continue
+
+                        # Album passed all filters, download it
+                        filtered_album_count += 1
+                        self.oprinter.newline()
+                        self.print(f'Album {filtered_album_count}: {album_info.name}', drop_level=1)
+
+                        # Download the album and collect track IDs
+                        if executor:
+                            download = self._submit_buffered(executor, self.download_album, album_id, artist_name=artist_name, path=base_path, indent_level=2, extra_kwargs=artist_info.album_extra_kwargs)
+                            self.set_indent_number(2)  # Same indentation as download_album leaves behind when run inline
+                        else:
+                            album_tracks = self.download_album(album_id, artist_name=artist_name, path=base_path, indent_level=2, extra_kwargs=artist_info.album_extra_kwargs)
+                            tracks_downloaded.extend(album_tracks)
+
+                    except Exception as e:
+                        self.print(f'Error processing album {album_id}: {str(e)}', drop_level=2)
                         continue
-                    
-                    # Album passed all filters, download it
-                    filtered_album_count += 1
-                    print()
-                    self.print(f'Album {filtered_album_count}: {album_info.name}', drop_level=1)
-                    
-                    # Download the album and collect track IDs
-                    album_tracks = self.download_album(album_id, artist_name=artist_name, path=base_path, indent_level=2, extra_kwargs=artist_info.album_extra_kwargs)
-                    tracks_downloaded.extend(album_tracks)
-                    
-                except Exception as e:
-                    self.print(f'Error processing album {album_id}: {str(e)}', drop_level=2)
-                    continue
-            
-            # Move to next batch
-            start += batch_size
-            
-            # If we got fewer albums than requested, we've reached the end
-            if len(album_ids) < batch_size:
-                break
+                    finally:
+                        if executor:
+                            queued_albums.append((self.oprinter.end_buffering(), album_id, download))
+                            self._flush_queued_albums(queued_albums, tracks_downloaded)
+
+                # If we got fewer albums than requested, we've reached the end
+                if len(album_ids) < batch_size:
+                    break
+            self._flush_queued_albums(queued_albums, tracks_downloaded, wait=True)
+        finally:
+            batches.close()
+            if executor: executor.shutdown()
 
         # --- PROCESS SEPARATE TRACKS ---
         self.set_indent_number(2)
@@ -625,13 +836,35 @@ class Downloader:
             if tracks_skipped > 0:
                 self.print(f'Tracks skipped: {tracks_skipped}', drop_level=1)
 
-    def download_track(self, track_id, album_location='', main_artist='', track_index=0, number_of_tracks=0, cover_temp_location='', indent_level=1, m3u_playlist=None, extra_kwargs={}):
-        quality_tier = QualityEnum[self.global_settings['general']['download_quality'].upper()]
-        codec_options = CodecOptions(
-            spatial_codecs = self.global_settings['codecs']['spatial_codecs'],
-            proprietary_codecs = self.global_settings['codecs']['proprietary_codecs'],
-        )
-        track_info: TrackInfo = self.service.get_track_info(track_id, quality_tier, codec_options, **extra_kwargs)
+    def download_track(self, track_id, *args, **kwargs):
+        # Records failed tracks in the current job, downloaded ones are recorded along with their file. Tracks can be
+        # downloaded on other threads, which need to be told the module the file downloads are rate limited as
+        self.finish_conversions(wait=False)
+        with rate_limited_as(self.service_name):
+            if not self.job: return self._download_track(track_id, *args, **kwargs)
+            try:
+                downloaded = self._download_track(track_id, *args, **kwargs)
+            except Exception as e:
+                self.job.set_track(track_id, 'failed', str(e))
+                raise
+        if not downloaded: self.job.set_track(track_id, 'failed')
+        return downloaded
+
+    def _download_track(self, track_id, album_location='', main_artist='', track_index=0, number_of_tracks=0, cover_temp_location='', indent_level=1, m3u_playlist=None, extra_kwargs={}, track_info: TrackInfo = None):
+        # Album and playlist downloads pass the already resolved track_info, avoiding a second metadata request
+        if not track_info:
+            done_track = self._get_done_tracks([track_id]).get(str(track_id))
+            if done_track:
+                self.set_indent_number(indent_level)
+                self.print('Track was already downloaded')
+                if m3u_playlist:
+                    self._add_track_m3u_playlist(m3u_playlist, done_track['path'], done_track['name'], done_track['artist'], done_track['duration'])
+                self.print(f'=== Track {track_id} skipped ===', drop_level=1)
+                return True
+            if self.job: self.job.set_track(track_id, 'running')
+            track_info = self._get_track_info(track_id, extra_kwargs)
+        elif self.job:
+            self.job.set_track(track_id, 'running')
         
         if track_info.error:
             self._log_unavailable_track(track_id, track_info, album_location)
@@ -729,8 +962,9 @@ class Downloader:
 
             # also make sure to add already existing tracks to the m3u playlist
             if m3u_playlist:
-                self._add_track_m3u_playlist(m3u_playlist, track_info, track_location)
+                self._add_track_m3u_playlist(m3u_playlist, track_location, track_info.name, track_info.artists[0], track_info.duration)
 
+            self._record_track(track_id, check_location, check_codec, track_info)
             self.print(f'=== Track {track_id} skipped ===', drop_level=1)
             return True  # Consider existing files as successful
 
@@ -738,12 +972,23 @@ class Downloader:
             with open(track_location_name + '.txt', 'w', encoding='utf-8') as f: f.write(track_info.description)
 
         # Begin process
-        print()
+        self.oprinter.newline()
         self.print("Downloading track file")
         try:
             download_info: TrackDownloadInfo = self.service.get_track_download(**track_info.download_extra_kwargs)
-            download_file(download_info.file_url, track_location, headers=download_info.file_url_headers, enable_progress_bar=True, indent_level=self.oprinter.indent_number) \
-                if download_info.download_type is DownloadEnum.URL else shutil.move(download_info.temp_file_path, track_location)
+            new_codec, warning = self._get_conversion(codec, conversions)
+            streamed = self._download_converted(download_info, codec, new_codec, track_location_name, warning)
+            if streamed:
+                codec = conversions[codec]
+                container = codec_data[codec].container
+                track_location = f'{track_location_name}.{container.name}'
+            elif download_info.download_type is DownloadEnum.URL:
+                # Progress bars are only shown when the output is not being buffered by a concurrent download
+                download_file(download_info.file_url, track_location, headers=download_info.file_url_headers, enable_progress_bar=not self.oprinter.buffering, indent_level=self.oprinter.indent_number)
+            elif download_info.download_type is DownloadEnum.MPD:
+                download_manifest(download_info.file_url, track_location, headers=download_info.file_url_headers, manifest=download_info.manifest)
+            else:
+                shutil.move(download_info.temp_file_path, track_location)
 
             # check if get_track_download returns a different codec, for example ffmpeg failed
             if download_info.different_codec:
@@ -769,7 +1014,7 @@ class Downloader:
             delete_cover = True
             covers_module_name = self.third_party_modules[ModuleModes.covers]
             covers_module_name = covers_module_name if covers_module_name != self.service_name else None
-            if covers_module_name: print()
+            if covers_module_name: self.oprinter.newline()
             self.print('Downloading artwork' + ((' with ' + covers_module_name) if covers_module_name else ''))
             
             jpg_cover_options = CoverOptions(file_type=ImageFileTypeEnum.jpg, resolution=self.global_settings['covers']['main_resolution'], \
@@ -779,10 +1024,13 @@ class Downloader:
                 compression=CoverCompressionEnum[self.global_settings['covers']['external_compression'].lower()])
             
             if covers_module_name:
-                default_temp = download_to_temp(track_info.cover_url)
+                default_temp = self.artwork_cache.download_to_temp(track_info.cover_url)
                 test_cover_options = CoverOptions(file_type=ImageFileTypeEnum.jpg, resolution=get_image_resolution(default_temp), compression=CoverCompressionEnum.high)
                 cover_module = self.loaded_modules[covers_module_name]
+                hash_threshold = self.global_settings['advanced']['cover_hash_threshold']
+                rms_check = self.global_settings['advanced']['cover_rms_check']
                 rms_threshold = self.global_settings['advanced']['cover_variance_threshold']
+                default_hash = self._get_cover_hash(track_info.cover_url, default_temp)
 
                 results: list[SearchResult] = self.search_by_tags(covers_module_name, track_info)
                 self.print('Covers to test: ' + str(len(results)))
@@ -791,31 +1039,36 @@ class Downloader:
                     test_cover_info: CoverInfo = cover_module.get_track_cover(r.result_id, test_cover_options, **r.extra_kwargs)
                     if test_cover_info.url not in attempted_urls:
                         attempted_urls.append(test_cover_info.url)
-                        test_temp = download_to_temp(test_cover_info.url)
-                        rms = compare_images(default_temp, test_temp)
-                        silentremove(test_temp)
-                        self.print(f'Attempt {i} RMS: {rms!s}') # The smaller the root mean square, the closer the image is to the desired one
-                        if rms < rms_threshold:
-                            self.print('Match found below threshold ' + str(rms_threshold))
+                        distance = hash_distance(default_hash, self._get_cover_hash(test_cover_info.url))
+                        self.print(f'Attempt {i} distance: {distance!s}') # Number of bits the perceptual hashes differ in
+                        match = distance <= hash_threshold
+                        if match and rms_check:  # Slower but more precise second stage on the full images
+                            test_temp = self.artwork_cache.download_to_temp(test_cover_info.url)
+                            rms = compare_images(default_temp, test_temp)
+                            silentremove(test_temp)
+                            self.print(f'Attempt {i} RMS: {rms!s}') # The smaller the root mean square, the closer the image is to the desired one
+                            match = rms < rms_threshold
+                        if match:
+                            self.print('Match found below threshold ' + str(rms_threshold if rms_check else hash_threshold))
                             jpg_cover_info: CoverInfo = cover_module.get_track_cover(r.result_id, jpg_cover_options, **r.extra_kwargs)
-                            download_file(jpg_cover_info.url, cover_temp_location, artwork_settings=self._get_artwork_settings(covers_module_name))
+                            self.artwork_cache.download(jpg_cover_info.url, cover_temp_location, artwork_settings=self._get_artwork_settings(covers_module_name))
                             silentremove(default_temp)
                             if self.global_settings['covers']['save_external']:
                                 ext_cover_info: CoverInfo = cover_module.get_track_cover(r.result_id, ext_cover_options, **r.extra_kwargs)
-                                download_file(ext_cover_info.url, f'{track_location_name}.{ext_cover_info.file_type.name}', artwork_settings=self._get_artwork_settings(covers_module_name, is_external=True))
+                                self.artwork_cache.download(ext_cover_info.url, f'{track_location_name}.{ext_cover_info.file_type.name}', artwork_settings=self._get_artwork_settings(covers_module_name, is_external=True))
                             break
                 else:
                     self.print('Third-party module could not find cover, using fallback')
                     shutil.move(default_temp, cover_temp_location)
             else:
-                download_file(track_info.cover_url, cover_temp_location, artwork_settings=self._get_artwork_settings())
+                self.artwork_cache.download(track_info.cover_url, cover_temp_location, artwork_settings=self._get_artwork_settings())
                 if self.global_settings['covers']['save_external'] and ModuleModes.covers in self.module_settings[self.service_name].module_supported_modes:
                     ext_cover_info: CoverInfo = self.service.get_track_cover(track_id, ext_cover_options, **track_info.cover_extra_kwargs)
-                    download_file(ext_cover_info.url, f'{track_location_name}.{ext_cover_info.file_type.name}', artwork_settings=self._get_artwork_settings(is_external=True))
+                    self.artwork_cache.download(ext_cover_info.url, f'{track_location_name}.{ext_cover_info.file_type.name}', artwork_settings=self._get_artwork_settings(is_external=True))
 
         if track_info.animated_cover_url and self.global_settings['covers']['save_animated_cover']:
             self.print('Downloading animated cover')
-            download_file(track_info.animated_cover_url, track_location_name + '_cover.mp4', enable_progress_bar=True)
+            download_file(track_info.animated_cover_url, track_location_name + '_cover.mp4', enable_progress_bar=not self.oprinter.buffering)
 
         # Get lyrics
         embedded_lyrics = ''
@@ -854,102 +1107,169 @@ class Downloader:
             # else:
             #     self.print('No credits available')
         
-        # Do conversions
+        # Do conversions, unless the track was already converted while downloading
+        new_codec = None
+        if codec in conversions and not streamed:
+            self.print(f'Converting to {codec_data[conversions[codec]].pretty_name}')
+            new_codec, warning = self._get_conversion(codec, conversions)
+            if warning: self.print(warning)
+
+        # Add the playlist track to the m3u playlist, here so it stays in order with conversions in the background
+        if m3u_playlist:
+            final_location = f'{track_location_name}.{codec_data[new_codec].container.name}' if new_codec else track_location
+            self._add_track_m3u_playlist(m3u_playlist, final_location, track_info.name, track_info.artists[0], track_info.duration)
+
+        if new_codec and self.conversion_executor:
+            if not delete_cover:  # The caller removes its cover once this returns, so the conversion gets a copy
+                cover_copy_location = create_temp_filename()
+                shutil.copyfile(cover_temp_location, cover_copy_location)
+                cover_temp_location, delete_cover = cover_copy_location, True
+            self.print('Converting in the background')
+            self._submit_conversion(track_id, self._convert_and_tag, track_id, track_info, codec, new_codec, track_location,
+                track_location_name, cover_temp_location, delete_cover, credits_list, embedded_lyrics)
+            return True
+        return self._convert_and_tag(track_id, track_info, codec, new_codec, track_location, track_location_name,
+            cover_temp_location, delete_cover, credits_list, embedded_lyrics)
+
+    def _convert_and_tag(self, track_id, track_info: TrackInfo, codec, new_codec, track_location, track_location_name, cover_temp_location, delete_cover, credits_list, embedded_lyrics):
+        # Converts the downloaded file to new_codec, if any, and tags it. Runs on the conversion pool if enabled
+        container = codec_data[codec].container
         old_track_location, old_container = None, None
-        if codec in conversions:
-            old_codec_data = codec_data[codec]
-            new_codec = conversions[codec]
+        if new_codec:
             new_codec_data = codec_data[new_codec]
-            self.print(f'Converting to {new_codec_data.pretty_name}')
-                
-            if old_codec_data.spatial or new_codec_data.spatial:
-                self.print('Warning: converting spacial formats is not allowed, skipping')
-            elif not old_codec_data.lossless and new_codec_data.lossless and not self.global_settings['advanced']['enable_undesirable_conversions']:
-                self.print('Warning: Undesirable lossy-to-lossless conversion detected, skipping')
-            elif not old_codec_data and not self.global_settings['advanced']['enable_undesirable_conversions']:
-                self.print('Warning: Undesirable lossy-to-lossy conversion detected, skipping')
-            else:
-                if not old_codec_data.lossless and new_codec_data.lossless:
-                    self.print('Warning: Undesirable lossy-to-lossless conversion')
-                elif not old_codec_data:
-                    self.print('Warning: Undesirable lossy-to-lossy conversion')
-
-                try:
-                    conversion_flags = {CodecEnum[k.upper()]:v for k,v in self.global_settings['advanced']['conversion_flags'].items()}
-                except:
-                    conversion_flags = {}
-                    self.print('Warning: conversion_flags setting is invalid, using defaults')
-                
-                conv_flags = conversion_flags[new_codec] if new_codec in conversion_flags else {}
-                temp_track_location = f'{create_temp_filename()}.{new_codec_data.container.name}'
-                new_track_location = f'{track_location_name}.{new_codec_data.container.name}'
-                
-                stream: ffmpeg = ffmpeg.input(track_location, hide_banner=None, y=None)
+            conv_flags = self._get_conversion_flags(new_codec)
+            temp_track_location = f'{create_temp_filename()}.{new_codec_data.container.name}'
+            new_track_location = f'{track_location_name}.{new_codec_data.container.name}'
+            
+            import ffmpeg  # Imported on first conversion, like the tagging below, to keep startup fast
+            stream: ffmpeg = ffmpeg.input(track_location, hide_banner=None, y=None)
+            # capture_stderr is required for the error output to be captured
+            try:
                 # capture_stderr is required for the error output to be captured
-                try:
-                    # capture_stderr is required for the error output to be captured
+                stream.output(
+                    temp_track_location,
+                    acodec=new_codec.name.lower(),
+                    **conv_flags,
+                    loglevel='error'
+                ).run(capture_stdout=True, capture_stderr=True)
+            except ffmpeg.Error as e:
+                error_msg = e.stderr.decode('utf-8')
+                # get the error message from ffmpeg and search foe the non-experimental encoder
+                encoder = re.search(r"(?<=non experimental encoder ')[^']+", error_msg)
+                if encoder:
+                    self.print(f'Encoder {new_codec.name.lower()} is experimental, trying {encoder.group(0)}')
+                    # try to use the non-experimental encoder
                     stream.output(
                         temp_track_location,
-                        acodec=new_codec.name.lower(),
+                        acodec=encoder.group(0),
                         **conv_flags,
                         loglevel='error'
-                    ).run(capture_stdout=True, capture_stderr=True)
-                except Error as e:
-                    error_msg = e.stderr.decode('utf-8')
-                    # get the error message from ffmpeg and search foe the non-experimental encoder
-                    encoder = re.search(r"(?<=non experimental encoder ')[^']+", error_msg)
-                    if encoder:
-                        self.print(f'Encoder {new_codec.name.lower()} is experimental, trying {encoder.group(0)}')
-                        # try to use the non-experimental encoder
-                        stream.output(
-                            temp_track_location,
-                            acodec=encoder.group(0),
-                            **conv_flags,
-                            loglevel='error'
-                        ).run()
-                    else:
-                        # raise any other occurring error
-                        raise Exception(f'ffmpeg error converting to {new_codec.name.lower()}:\n{error_msg}')
-
-                # remove file if it requires an overwrite, maybe os.replace would work too?
-                if track_location == new_track_location:
-                    silentremove(track_location)
-                    # just needed so it won't get deleted
-                    track_location = temp_track_location
-
-                # move temp_file to new_track_location and delete temp file
-                shutil.move(temp_track_location, new_track_location)
-                silentremove(temp_track_location)
-
-                if self.global_settings['advanced']['conversion_keep_original']:
-                    old_track_location = track_location
-                    old_container = container
+                    ).run()
                 else:
-                    silentremove(track_location)
+                    # raise any other occurring error
+                    raise Exception(f'ffmpeg error converting to {new_codec.name.lower()}:\n{error_msg}')
 
-                container = new_codec_data.container    
-                track_location = new_track_location
+            # remove file if it requires an overwrite, maybe os.replace would work too?
+            if track_location == new_track_location:
+                silentremove(track_location)
+                # just needed so it won't get deleted
+                track_location = temp_track_location
 
-        # Add the playlist track to the m3u playlist
-        if m3u_playlist:
-            self._add_track_m3u_playlist(m3u_playlist, track_info, track_location)
+            # move temp_file to new_track_location and delete temp file
+            shutil.move(temp_track_location, new_track_location)
+            silentremove(temp_track_location)
+
+            if self.global_settings['advanced']['conversion_keep_original']:
+                old_track_location = track_location
+                old_container = container
+            else:
+                silentremove(track_location)
+
+            container = new_codec_data.container    
+            track_location = new_track_location
 
         # Finally tag file
         self.print('Tagging file')
+        from orpheus.tagging import tag_file
         try:
+            tag_padding = self.global_settings['advanced']['tag_padding']
+            archive_id = f'{self.service_name}:{(new_codec or codec).name}:{track_id}' if self.archive else None  # Lets --rebuildarchive find it
             tag_file(track_location, cover_temp_location if self.global_settings['covers']['embed_cover'] else None,
-                     track_info, credits_list, embedded_lyrics, container)
+                     track_info, credits_list, embedded_lyrics, container, tag_padding.get(container.name, 'auto'), archive_id)
             if old_track_location:
                 tag_file(old_track_location, cover_temp_location if self.global_settings['covers']['embed_cover'] else None,
-                         track_info, credits_list, embedded_lyrics, old_container)
+                         track_info, credits_list, embedded_lyrics, old_container, tag_padding.get(old_container.name, 'auto'))
         except TagSavingFailure:
             self.print('Tagging failed, tags saved to text file')
         if delete_cover:
             silentremove(cover_temp_location)
-        
+
+        self._record_track(track_id, track_location, new_codec or codec, track_info)
         self.print(f'=== Track {track_id} downloaded ===', drop_level=1)
         return True
 
+    def _get_conversion(self, codec, conversions):
+        # The codec a track is converted to, None if there's no conversion or it isn't allowed, and a warning if any
+        if codec not in conversions: return None, None
+        old_codec_data, new_codec_data = codec_data[codec], codec_data[conversions[codec]]
+        if old_codec_data.spatial or new_codec_data.spatial:
+            return None, 'Warning: converting spacial formats is not allowed, skipping'
+        elif not old_codec_data.lossless and new_codec_data.lossless and not self.global_settings['advanced']['enable_undesirable_conversions']:
+            return None, 'Warning: Undesirable lossy-to-lossless conversion detected, skipping'
+        elif not old_codec_data and not self.global_settings['advanced']['enable_undesirable_conversions']:
+            return None, 'Warning: Undesirable lossy-to-lossy conversion detected, skipping'
+        elif not old_codec_data.lossless and new_codec_data.lossless:
+            return conversions[codec], 'Warning: Undesirable lossy-to-lossless conversion'
+        elif not old_codec_data:
+            return conversions[codec], 'Warning: Undesirable lossy-to-lossy conversion'
+        return conversions[codec], None
+
+    def _get_conversion_flags(self, new_codec):
+        try:
+            conversion_flags = {CodecEnum[k.upper()]:v for k,v in self.global_settings['advanced']['conversion_flags'].items()}
+        except:
+            conversion_flags = {}
+            self.print('Warning: conversion_flags setting is invalid, using defaults')
+        return conversion_flags[new_codec] if new_codec in conversion_flags else {}
+
+    def _download_converted(self, download_info: TrackDownloadInfo, codec, new_codec, track_location_name, warning=None):
+        # Converts the track while downloading it if the original isn't kept and ffmpeg can read its container from a
+        # pipe, unlike MP4's. Returns whether it did, if streaming fails the track is downloaded and converted as usual
+        if not new_codec or download_info.download_type is not DownloadEnum.URL or download_info.different_codec \
+                or not self.global_settings['advanced']['streaming_conversion'] or self.global_settings['advanced']['conversion_keep_original'] \
+                or codec_data[codec].container not in pipeable_containers:
+            return False
+        self.print(f'Converting to {codec_data[new_codec].pretty_name} while downloading')
+        if warning: self.print(warning)
+        while True:
+            encoder = self.streaming_encoders.get(new_codec, new_codec.name.lower())
+            try:
+                download_to_ffmpeg(download_info.file_url, f'{track_location_name}.{codec_data[new_codec].container.name}',
+                    {'acodec': encoder, **self._get_conversion_flags(new_codec)}, headers=download_info.file_url_headers or {},
+                    enable_progress_bar=not self.oprinter.buffering, indent_level=self.oprinter.indent_number)
+                return True
+            except Exception as e:
+                # ffmpeg fails before reading much if the encoder is experimental, so retrying with the one it suggests
+                # is cheap. The encoder is remembered for the next tracks
+                non_experimental = re.search(r"(?<=non experimental encoder ')[^']+", str(e))
+                if non_experimental and non_experimental.group(0) != encoder:
+                    self.print(f'Encoder {encoder} is experimental, trying {non_experimental.group(0)}')
+                    self.streaming_encoders[new_codec] = non_experimental.group(0)
+                    continue
+                if self.global_settings['advanced']['debug_mode']: raise
+                self.print(f'Warning: Converting while downloading failed, converting after the download: {e}')
+                return False
+
+    def _get_cover_hash(self, url, image_location=None):
+        # Perceptual hashes are looked up by URL first, so a cover only has to be downloaded the first time it's compared
+        image_hash = self.cover_hash_index.get(url)
+        if image_hash is None:
+            temp_location = image_location or self.artwork_cache.download_to_temp(url)
+            image_hash = perceptual_hash(temp_location)
+            if not image_location: silentremove(temp_location)
+            self.cover_hash_index.set(url, image_hash)
+        return image_hash
+
     def _get_artwork_settings(self, module_name = None, is_external = False):
         if not module_name:
             module_name = self.service_name
@@ -0,0 +1,129 @@
+import copy, json, logging, os, re, threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from orpheus.core import Orpheus, oprinter, print_resumable_jobs, run_job
+from orpheus.dispatcher import URLDispatcher
+from orpheus.jobs import JobQueue
+from orpheus.music_downloader import Downloader
+from utils.models import DownloadTypeEnum, MediaIdentification, ModuleModes
+
+
+class OrpheusServer(ThreadingHTTPServer):
+    # Keeps an Orpheus session, with its modules loaded and logged in, between jobs. Jobs are submitted over a local HTTP
+    # API, added to the job queue and downloaded by a pool of workers, which share one Downloader's caches. The workers
+    # only claim the server's own jobs, other runs sharing the queue keep theirs, and with resume the unfinished jobs of
+    # runs that had exited when the server started
+    daemon_threads = True
+    finished_job_age = 3600  # Seconds finished jobs are kept for their status to be requested
+    poll_interval = 10  # Seconds between workers checking for jobs added by other processes
+
+    def __init__(self, orpheus_session: Orpheus, host, port, workers, resume=False):
+        super().__init__((host, port), RequestHandler)
+        self.orpheus = orpheus_session
+        self.job_queue = JobQueue(os.path.join(orpheus_session.data_folder_base, 'jobs.db'))
+        self.dispatcher = URLDispatcher(orpheus_session.module_netloc_constants, orpheus_session.module_settings, orpheus_session.load_module)
+        self.jobs_added = threading.Condition()
+        self.resume, self.resumable = resume, self.job_queue.resumable()  # Listed before the workers take them
+
+        self.download_path = orpheus_session.settings['global']['general']['download_path']
+        self.output_roots = [os.path.realpath(i) for i in [self.download_path] + orpheus_session.settings['global']['server']['allowed_output_paths']]
+        downloader = Downloader(orpheus_session.settings['global'], orpheus_session.module_controls, oprinter, self.download_path)
+        os.makedirs('temp', exist_ok=True)
+        for _ in range(workers):
+            threading.Thread(target=self.work, args=(copy.copy(downloader),), daemon=True).start()
+
+    def work(self, downloader: Downloader):
+        resume = self.resume
+        while True:
+            for job in self.job_queue.claim(resume):
+                run_job(self.orpheus, downloader, job)
+            resume = False
+            self.job_queue.remove_finished(self.finished_job_age)
+            with self.jobs_added:
+                self.jobs_added.wait(self.poll_interval)
+
+    def submit(self, request: dict):
+        # Adds the URLs and media of a request as jobs. Returns the job IDs and the URLs that were rejected
+        if not isinstance(request, dict):
+            raise ValueError('The request must be an object')
+        urls, media_list = request.get('urls', []), request.get('media', [])
+        if not isinstance(urls, list) or not all(isinstance(i, str) for i in urls):
+            raise ValueError('urls must be a list of strings')
+        if not isinstance(media_list, list) or not all(isinstance(i, dict) for i in media_list):
+            raise ValueError('media must be a list of objects')
+        media_to_download, rejected = self.dispatcher.dispatch(urls)
+        for media in media_list:
+            module = media['module'].lower()
+            if module not in self.orpheus.module_list:
+                raise ValueError(f'Unknown module "{module}"')
+            media_to_download.setdefault(module, []).append(MediaIdentification(media_type=DownloadTypeEnum[media['media_type'].lower()],
+                media_id=str(media['media_id']), extra_kwargs=media.get('extra_kwargs', {})))
+
+        third_party_modules = {}
+        for mode in (ModuleModes.covers, ModuleModes.lyrics, ModuleModes.credits):
+            module = request.get(mode.name, 'default').lower()
+            if module == 'default': module = self.orpheus.settings['global']['module_defaults'][mode.name]
+            third_party_modules[mode] = module if module != 'default' else None
+        output_path = request.get('output_path', self.download_path)
+        if not any(os.path.commonpath([os.path.realpath(output_path), root]) == root for root in self.output_roots):
+            raise ValueError(f'Output path "{output_path}" is not in the download path or allowed_output_paths')
+        options = {'third_party_modules': third_party_modules, 'output_path': output_path,
+            'separate_download_module': request.get('separate_download_module', 'default').lower()}
+
+        job_ids = [self.job_queue.add(module, media, options) for module, items in media_to_download.items() for media in items]
+        with self.jobs_added:
+            self.jobs_added.notify_all()
+        return job_ids, [{'position': position, 'url': url, 'reason': reason} for position, url, reason in rejected]
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    # POST /jobs submits jobs, GET /jobs returns the state of the queue and GET /jobs/<id> that of a single job
+    server: OrpheusServer
+
+    def log_message(self, format, *args):
+        logging.debug('Server: ' + format % args)
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip('/') == '/jobs':
+            jobs, tracks, failed_jobs = self.server.job_queue.status()
+            return self.send_json(200, {'jobs': jobs, 'tracks': tracks, 'failed': [job_to_dict(i) for i in failed_jobs]})
+
+        match = re.fullmatch(r'/jobs/(\d+)/?', self.path)
+        job, tracks = self.server.job_queue.job_status(int(match.group(1))) if match else (None, None)
+        if not job:
+            return self.send_json(404, {'error': 'Not found'})
+        self.send_json(200, {**job_to_dict(job), 'tracks': tracks})
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/jobs':
+            return self.send_json(404, {'error': 'Not found'})
+        # Browsers send other content types cross-origin without asking first, so web pages can't submit jobs
+        if self.headers.get_content_type() != 'application/json':
+            return self.send_json(415, {'error': 'Content-Type must be application/json'})
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            job_ids, rejected = self.server.submit(request)
+        except (ValueError, KeyError, TypeError, AttributeError) as e:  # Invalid JSON, media types or missing fields
+            return self.send_json(400, {'error': f'Invalid request: {e!r}'})
+        self.send_json(202, {'jobs': job_ids, 'rejected': rejected})
+
+
+def job_to_dict(job):
+    return {'id': job['id'], 'service': job['service'], 'media_type': job['media_type'], 'media_id': job['media_id'],
+        'state': job['state'], 'error': job['error']}
+
+
+def serve(orpheus_session: Orpheus, resume=False):
+    server_settings = orpheus_session.settings['global']['server']
+    server = OrpheusServer(orpheus_session, server_settings['host'], server_settings['port'], server_settings['workers'], resume)
+    print_resumable_jobs(server.resumable, resume)
+    print(f'Listening for jobs on http://{server_settings["host"]}:{server_settings["port"]}/jobs')
+    server.serve_forever()
@@ -3,24 +3,36 @@ import logging
 from dataclasses import asdict
 
 from PIL import Image
+from mutagen import PaddingInfo
 from mutagen.easyid3 import EasyID3
-from mutagen.easymp4 import EasyMP4
+from mutagen.easymp4 import EasyMP4, EasyMP4Tags
 from mutagen.flac import FLAC, Picture
 from mutagen.id3 import PictureType, APIC, USLT, TDAT, COMM, TPUB
 from mutagen.mp3 import EasyMP3
 from mutagen.mp4 import MP4Cover
-from mutagen.mp4 import MP4Tags
 from mutagen.oggopus import OggOpus
 from mutagen.oggvorbis import OggVorbis
 
+from orpheus.archive import archive_tag
 from utils.exceptions import *
 from utils.models import ContainerEnum, TrackInfo
 
-# Needed for Windows tagging support
-MP4Tags._padding = 0
 
+def get_padding_function(policy, payload_size):
+    # Tags are written in place whenever they fit in the file's padding, as resizing it moves all the audio after it.
+    # If they don't fit the file is rewritten anyway, and gets policy KiB of padding, or with "auto" as much as the
+    # cover and lyrics take, so tagging it again with different ones stays in place. That is unless less audio than
+    # that follows the tags, like in MP4 files with their tags at the end, where moving it again is cheaper
+    def padding(info: PaddingInfo):
+        if info.padding >= 0:
+            return info.padding
+        if policy == 'auto':
+            return max(min(payload_size, info.size), info.get_default_padding())
+        return int(policy) * 1024
+    return padding
 
-def tag_file(file_path: str, image_path: str, track_info: TrackInfo, credits_list: list, embedded_lyrics: str, container: ContainerEnum):
+
+def tag_file(file_path: str, image_path: str, track_info: TrackInfo, credits_list: list, embedded_lyrics: str, container: ContainerEnum, padding_policy='auto', archive_id=None):
     if container == ContainerEnum.flac:
         tagger = FLAC(file_path)
     elif container == ContainerEnum.opus:
@@ -40,6 +52,7 @@ def tag_file(file_path: str, image_path: str, track_info: TrackInfo, credits_lis
         tagger.tags.RegisterTXXXKey('minor_version', 'minor_version')
         tagger.tags.RegisterTXXXKey('Rating', 'Rating')
         tagger.tags.RegisterTXXXKey('upc', 'BARCODE')
+        tagger.tags.RegisterTXXXKey(archive_tag.lower(), archive_tag)
 
         tagger.tags.pop('encoded', None)
     elif container == ContainerEnum.m4a:
@@ -51,6 +64,7 @@ def tag_file(file_path: str, image_path: str, track_info: TrackInfo, credits_lis
         tagger.RegisterTextKey('explicit', 'rtng') if track_info.explicit is not None else None
         tagger.RegisterTextKey('covr', 'covr')
         tagger.RegisterTextKey('lyrics', '\xa9lyr') if embedded_lyrics else None
+        EasyMP4Tags.RegisterFreeformKey(archive_tag.lower(), archive_tag)
     else:
         raise Exception('Unknown container for tagging')
 
@@ -101,6 +115,7 @@ def tag_file(file_path: str, image_path: str, track_info: TrackInfo, credits_lis
         tagger['date'] = str(track_info.release_year)
 
     if track_info.tags.copyright:tagger['copyright'] = track_info.tags.copyright
+    if archive_id: tagger[archive_tag.lower()] = archive_id
 
     if track_info.explicit is not None:
         if container == ContainerEnum.m4a:
@@ -191,6 +206,7 @@ def tag_file(file_path: str, image_path: str, track_info: TrackInfo, credits_lis
         tagger['REPLAYGAIN_TRACK_PEAK'] = str(track_info.tags.replay_peak)
 
     # only embed the cover when embed_cover is set to True
+    payload_size = len(embedded_lyrics.encode('utf-8')) if embedded_lyrics else 0
     if image_path:
         with open(image_path, 'rb') as c:
             data = c.read()
@@ -199,14 +215,17 @@ def tag_file(file_path: str, image_path: str, track_info: TrackInfo, credits_lis
 
         # Check if cover is smaller than 16MB
         if len(picture.data) < picture._MAX_SIZE:
+            payload_size += len(data) * 4 // 3 if container in {ContainerEnum.ogg, ContainerEnum.opus} else len(data)  # Base64 in Ogg
             if container == ContainerEnum.flac:
                 picture.type = PictureType.COVER_FRONT
                 picture.mime = u'image/jpeg'
+                tagger.clear_pictures()  # Replaces a cover the file came with, so its space can be reused in place
                 tagger.add_picture(picture)
             elif container == ContainerEnum.m4a:
                 tagger['covr'] = [MP4Cover(data, imageformat=MP4Cover.FORMAT_JPEG)]
             elif container == ContainerEnum.mp3:
                 # Never access protected attributes, too bad!
+                tagger.tags._EasyID3__id3.delall('APIC')
                 tagger.tags._EasyID3__id3._DictProxy__dict['APIC'] = APIC(
                     encoding=3,  # UTF-8
                     mime='image/jpeg',
@@ -231,7 +250,8 @@ def tag_file(file_path: str, image_path: str, track_info: TrackInfo, credits_lis
                   f'will not have cover saved.')
 
     try:
-        tagger.save(file_path, v1=2, v2_version=3, v23_sep=None) if container == ContainerEnum.mp3 else tagger.save()
+        padding = get_padding_function(padding_policy, payload_size)
+        tagger.save(file_path, v1=2, v2_version=3, v23_sep=None, padding=padding) if container == ContainerEnum.mp3 else tagger.save(padding=padding)
     except:
         logging.debug('Tagging failed.')
         tag_text = '\n'.join((f'{k}: {v}' for k, v in asdict(track_info.tags).items() if v and k != 'credits' and k != 'lyrics'))
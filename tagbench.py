@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+import argparse, os, random, shutil, subprocess, tempfile
+
+from PIL import Image
+
+import orpheus.tagging
+from orpheus.tagging import tag_file
+from utils.models import ContainerEnum, Tags, TrackInfo
+
+# Encoder of the test file of every container
+encoders = {ContainerEnum.flac: 'flac', ContainerEnum.m4a: 'aac', ContainerEnum.mp3: 'libmp3lame', ContainerEnum.ogg: 'libvorbis',
+    ContainerEnum.opus: 'libopus'}
+
+def make_cover(path, size):
+    # A noise JPEG, which doesn't compress, of about size pixels squared
+    rng = random.Random(size)
+    Image.frombytes('RGB', (size, size), bytes(rng.getrandbits(8) for _ in range(size * size * 3))).save(path, quality=90)
+
+def changed_bytes(old, new):
+    # Bytes of new that differ from old at the same position, which tagging must have written. Resizing the tags moves
+    # all the audio after them, so it counts as written too
+    return sum(a != b for a, b in zip(old, new)) + max(len(new) - len(old), 0)
+
+def main():
+    parser = argparse.ArgumentParser(description='Orpheus Tagging Bytes Written Benchmark')
+    parser.add_argument('-d', '--duration', type=int, default=60, help='Duration of the test files in seconds')
+    parser.add_argument('-p', '--policy', default='auto', help='tag_padding policy to compare to mutagen\'s default padding')
+    args = parser.parse_args()
+
+    track_info = TrackInfo(name='Track', album='Album', album_id='1', artists=['Artist'], tags=Tags(isrc='X'), codec=None, cover_url='',
+        release_year=2020)
+    lyrics = 'La la la\n' * 500
+    default_padding_function = orpheus.tagging.get_padding_function
+
+    def tag_with_padding(policy, *tag_file_args):
+        # Without a policy, mutagen's default padding is used, which shrinks large padding and only adds a little
+        orpheus.tagging.get_padding_function = default_padding_function if policy else lambda *_: None
+        try:
+            tag_file(*tag_file_args)
+        finally:
+            orpheus.tagging.get_padding_function = default_padding_function
+
+    with tempfile.TemporaryDirectory() as temp:
+        # Tagged with a cover, then again with a larger and with a smaller one, as when a track is tagged again
+        covers = [os.path.join(temp, f'cover{i}.jpg') for i in range(3)]
+        for path, size in zip(covers, (500, 600, 400)): make_cover(path, size)
+        print(f'Covers of {", ".join(f"{os.path.getsize(i) / 1024:.0f}" for i in covers)} KiB')
+
+        for container, encoder in encoders.items():
+            source = os.path.join(temp, f'source.{container.name}')
+            subprocess.run(['ffmpeg', '-hide_banner', '-loglevel', 'error', '-f', 'lavfi', '-i', f'anoisesrc=d={args.duration}',
+                '-ac', '2', '-c:a', encoder, source], check=True)
+            results = {}
+            for scenario in ('fresh', 'pre-tagged'):
+                for name, policy in (('default', None), (args.policy, args.policy)):
+                    path = os.path.join(temp, f'{name}.{container.name}')
+                    shutil.copyfile(source, path)
+                    if scenario == 'pre-tagged':  # As downloaded from services that embed their own cover
+                        tag_with_padding(None, path, covers[1], track_info, [], None, container, None)
+                    with open(path, 'rb') as f: data = f.read()
+                    written = results[f'{scenario}, {name}'] = []
+                    for cover in covers:
+                        tag_with_padding(policy, path, cover, track_info, [], lyrics, container, policy)
+                        with open(path, 'rb') as f: new_data = f.read()
+                        written.append(changed_bytes(data, new_data))
+                        data = new_data
+
+            print(f'{container.name} ({os.path.getsize(source) / 1024:.0f} KiB):')
+            for name, written in results.items():
+                print(f'\t{name}: {", ".join(f"{i / 1024:.0f}" for i in written)} KiB written, {sum(written) / 1024:.0f} KiB total')
+
+if __name__ == '__main__':
+    main()
@@ -30,4 +30,10 @@ class ModuleSettingsNotSet(Exception):
     pass # TODO: will either tell you to add settings for a specific module in simple sessions mode, or the command needed to set a setting in advanced sessions mode
 
 class TagSavingFailure(Exception):
-    pass
\ No newline at end of file
+    pass
+
+class DownloadRangeError(Exception):
+    pass # Raised when a server stops honouring the byte ranges of a segmented download
+
+class DownloadStalledError(Exception):
+    pass # Raised when a download stays below the minimum speed, it is reconnected from the last received byte
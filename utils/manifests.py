@@ -0,0 +1,210 @@
+import io, math, os, re, requests, shutil
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Optional
+from urllib.parse import urljoin
+
+from utils.exceptions import DownloadStalledError
+from utils.utils import DownloadProgress, count_stall, download_settings, download_timeout, r_session, rate_limit_context, \
+    rate_limited_as, resume_attempts, silentremove, stream_response
+
+
+@dataclass
+class Segment:
+    url: str
+    byte_range: Optional[tuple] = None  # (first byte, last byte)
+
+
+def parse_duration(duration):
+    # ISO 8601 durations as used by MPDs, e.g. PT3M25.5S, in seconds
+    match = re.fullmatch(r'P(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:([\d.]+)S)?)?', duration or '')
+    if not match: return 0
+    days, hours, minutes, seconds = match.groups()
+    return int(days or 0) * 86400 + int(hours or 0) * 3600 + int(minutes or 0) * 60 + float(seconds or 0)
+
+def parse_byte_range(byte_range):
+    # "100-199" gives (100, 199)
+    if not byte_range: return None
+    start, end = byte_range.split('-')
+    return int(start), int(end)
+
+def fill_template(template, representation, number=None, time=None):
+    # Replaces the $RepresentationID$, $Bandwidth$, $Number$ and $Time$ identifiers of a SegmentTemplate, with their
+    # optional printf widths like $Number%05d$. $$ is an escaped $
+    values = {'RepresentationID': representation.get('id'), 'Bandwidth': representation.get('bandwidth'), 'Number': number, 'Time': time}
+    def replace(match):
+        if not match.group(1): return '$'
+        value = values[match.group(1)]
+        return match.group(2) % int(value) if match.group(2) else str(value)
+    return re.sub(r'\$(RepresentationID|Bandwidth|Number|Time|)(%0?\d*d)?\$', replace, template)
+
+def parse_mpd(text, url):
+    # Segments of the highest bandwidth audio representation of every period, initialization segments first
+    from defusedxml import ElementTree  # Imported on first use, manifests are untrusted XML
+    mpd = ElementTree.fromstring(text)
+    for element in mpd.iter():
+        element.tag = element.tag.split('}')[-1]  # Drops the namespace
+    if mpd.get('type') == 'dynamic':
+        raise Exception('Live DASH streams are not supported')
+
+    base_url = lambda element, parent_url: urljoin(parent_url, element.findtext('BaseURL', '').strip())
+    mpd_url = base_url(mpd, url)
+    periods = mpd.findall('Period')
+
+    segments = []
+    for period in periods:
+        period_duration = parse_duration(period.get('duration') or (mpd.get('mediaPresentationDuration') if len(periods) == 1 else None))
+        adaptation_sets = period.findall('AdaptationSet')
+        audio_sets = [i for i in adaptation_sets if i.get('contentType') == 'audio' or (i.get('mimeType') or '').startswith('audio')
+            or any((j.get('mimeType') or '').startswith('audio') for j in i.findall('Representation'))]
+        representations = [(adaptation_set, representation) for adaptation_set in (audio_sets or adaptation_sets)
+            for representation in adaptation_set.findall('Representation')]
+        if not representations:
+            raise Exception('No representation found in the DASH manifest')
+        adaptation_set, representation = max(representations, key=lambda i: int(i[1].get('bandwidth', 0)))
+        representation_url = base_url(representation, base_url(adaptation_set, base_url(period, mpd_url)))
+
+        # Segment information is inherited from the adaptation set, and overridden by the representation
+        template_elements = [i for i in (adaptation_set.find('SegmentTemplate'), representation.find('SegmentTemplate')) if i is not None]
+        segment_list = representation.find('SegmentList') if representation.find('SegmentList') is not None else adaptation_set.find('SegmentList')
+        if template_elements:
+            template = {k: v for i in template_elements for k, v in i.attrib.items()}
+            timeline = next((i.find('SegmentTimeline') for i in reversed(template_elements) if i.find('SegmentTimeline') is not None), None)
+            timescale, number = int(template.get('timescale', 1)), int(template.get('startNumber', 1))
+            if 'initialization' in template:
+                segments.append(Segment(urljoin(representation_url, fill_template(template['initialization'], representation))))
+
+            if timeline is not None:
+                time = 0
+                for s in timeline.findall('S'):
+                    time, duration, repeat = int(s.get('t', time)), int(s.get('d')), int(s.get('r', 0))
+                    if repeat < 0:  # Repeats until the end of the period
+                        repeat = math.ceil((period_duration * timescale - time) / duration) - 1
+                    for _ in range(repeat + 1):
+                        segments.append(Segment(urljoin(representation_url, fill_template(template['media'], representation, number, time))))
+                        time, number = time + duration, number + 1
+            else:
+                if not template.get('duration') or not period_duration:
+                    raise Exception('Cannot tell the number of segments of the DASH manifest')
+                for i in range(math.ceil(period_duration * timescale / int(template['duration']))):
+                    segments.append(Segment(urljoin(representation_url, fill_template(template['media'], representation, number + i))))
+        elif segment_list is not None:
+            initialization = segment_list.find('Initialization')
+            if initialization is not None:
+                segments.append(Segment(urljoin(representation_url, initialization.get('sourceURL', '')), parse_byte_range(initialization.get('range'))))
+            for segment_url in segment_list.findall('SegmentURL'):
+                segments.append(Segment(urljoin(representation_url, segment_url.get('media', '')), parse_byte_range(segment_url.get('mediaRange'))))
+        else:  # SegmentBase, or just a BaseURL, is a single file
+            segments.append(Segment(representation_url))
+    return segments
+
+def parse_hls(text, url, headers):
+    # Segments of the highest bandwidth variant, with its initialization sections
+    import m3u8  # Imported on first use
+    playlist = m3u8.loads(text, uri=url)
+    if playlist.is_variant:
+        variant = max(playlist.playlists, key=lambda i: i.stream_info.bandwidth or 0)
+        response = r_session.get(variant.absolute_uri, headers=headers, verify=False, timeout=download_timeout())
+        response.raise_for_status()
+        playlist = m3u8.loads(response.text, uri=variant.absolute_uri)
+    if any(key and key.method != 'NONE' for key in playlist.keys):
+        raise Exception('Encrypted HLS streams are not supported')
+
+    segments, init_section, offsets = [], None, {}
+    def to_segment(uri, byte_range):
+        # EXT-X-BYTERANGE is "length[@offset]", without an offset it follows the previous range of the same file
+        if not byte_range: return Segment(uri)
+        length, _, offset = byte_range.partition('@')
+        start = int(offset) if offset else offsets.get(uri, 0)
+        offsets[uri] = start + int(length)
+        return Segment(uri, (start, start + int(length) - 1))
+
+    for segment in playlist.segments:
+        if segment.init_section and (segment.init_section.absolute_uri, segment.init_section.byterange) != init_section:
+            init_section = (segment.init_section.absolute_uri, segment.init_section.byterange)
+            segments.append(to_segment(*init_section))
+        segments.append(to_segment(segment.absolute_uri, segment.byterange))
+    return segments
+
+def fetch_segment(segment: Segment, headers, module_name):
+    # Returns the segment's data, reconnecting like download_file if the connection stalls or drops
+    request_headers = {**headers, 'Range': f'bytes={segment.byte_range[0]}-{segment.byte_range[1]}'} if segment.byte_range else headers
+    for attempt in range(1, resume_attempts + 1):
+        try:
+            with rate_limited_as(module_name), r_session.get(segment.url, stream=True, headers=request_headers, verify=False, timeout=download_timeout()) as r:
+                r.raise_for_status()
+                data = io.BytesIO()
+                for _ in stream_response(r, data, DownloadProgress(False)): pass
+                if segment.byte_range and r.status_code == 200:  # The server ignored the range
+                    return data.getvalue()[segment.byte_range[0]:segment.byte_range[1] + 1]
+                return data.getvalue()
+        except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError, DownloadStalledError) as e:
+            if not count_stall(segment.url, e) or attempt == resume_attempts: raise
+
+def get_format(data: bytes):
+    # Container of a stream from its first bytes
+    if data[4:8] in (b'ftyp', b'styp', b'moof', b'sidx', b'moov'): return 'mp4'
+    if data[:4] == b'\x1aE\xdf\xa3': return 'webm'
+    if data[:1] == b'\x47': return 'ts'
+    return None
+
+def download_manifest(url, file_location, headers=None, manifest=None):
+    # Downloads a DASH (MPD) or HLS (m3u8) stream into file_location. The segments are fetched segment_connections at a
+    # time through the shared session, so with its retries and rate limits, and written in order as they arrive. Only
+    # a few more than that are kept in memory. manifest is the manifest itself if the module already has it, url is
+    # then only used to resolve relative segment URLs
+    if os.path.isfile(file_location):
+        return None
+    headers = headers or {}
+    if manifest is None:
+        response = r_session.get(url, headers=headers, verify=False, timeout=download_timeout())
+        response.raise_for_status()
+        manifest = response.text
+
+    segments = parse_hls(manifest, url, headers) if manifest.lstrip().startswith('#EXTM3U') else parse_mpd(manifest, url)
+    if not segments:
+        raise Exception('The stream manifest has no segments')
+
+    connections = max(download_settings['segment_connections'], 1)
+    module_name = getattr(rate_limit_context, 'module', None)  # Rate limit context is per thread
+    part_location, stream_format = file_location + '.part', None
+    with ThreadPoolExecutor(max_workers=connections) as executor, open(part_location, 'wb') as f:
+        pending = deque()
+        def write_next():
+            nonlocal stream_format
+            data = pending.popleft().result()
+            stream_format = stream_format or get_format(data)
+            f.write(data)
+
+        try:
+            for segment in segments:
+                pending.append(executor.submit(fetch_segment, segment, headers, module_name))
+                if len(pending) > connections * 2: write_next()
+            while pending: write_next()
+        except BaseException:
+            for future in pending: future.cancel()
+            raise
+
+    # The stitched segments are remuxed into a regular file of the extension's container, so it has a duration and a
+    # seek index. Without ffmpeg, segments already in that container are kept as they are
+    extension = os.path.splitext(file_location)[1][1:].lower()
+    native = not stream_format or extension in {'mp4': ('m4a', 'mp4'), 'webm': ('webm',), 'ts': ('ts',)}[stream_format]
+    if extension == 'ts' and native:
+        os.replace(part_location, file_location)
+        return
+
+    import ffmpeg  # Imported on first use, like in the Downloader
+    remux_location = f'{file_location}.remux.{extension}'
+    try:
+        ffmpeg.input(part_location, hide_banner=None, y=None).output(remux_location, c='copy', loglevel='error').run(capture_stdout=True, capture_stderr=True)
+    except FileNotFoundError:  # No ffmpeg binary
+        if not native: raise Exception(f'ffmpeg is needed to remux the {stream_format} stream to {extension}')
+        os.replace(part_location, file_location)
+        return
+    except ffmpeg.Error as e:
+        silentremove(remux_location)
+        silentremove(part_location)
+        raise Exception(f'ffmpeg error remuxing the {stream_format} stream to {extension}:\n{e.stderr.decode("utf-8")}')
+    silentremove(part_location)
+    shutil.move(remux_location, file_location)
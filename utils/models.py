@@ -1,4 +1,4 @@
-import os
+import os, threading
 from dataclasses import dataclass, field
 from enum import Flag, auto
 from types import ClassMethodDescriptorType, FunctionType
@@ -9,10 +9,22 @@ from utils.utils import read_temporary_setting, set_temporary_setting
 
 class Oprinter:  # Could change to inherit from print class instead, but this is fine
     def __init__(self):
+        self.local = threading.local()  # Per-thread indentation and output buffers used by concurrent downloads
+        self.main_indent_number = 1
         self.indent_number = 1
         self.printing_enabled = True
         self.multiplier = 8
 
+    @property
+    def indent_number(self):
+        # Threads that never set an indentation follow the main thread
+        return getattr(self.local, 'indent_number', self.main_indent_number)
+
+    @indent_number.setter
+    def indent_number(self, number: int):
+        self.local.indent_number = number
+        if threading.current_thread() is threading.main_thread(): self.main_indent_number = number
+
     def set_indent_number(self, number: int):
         try:
             size = os.get_terminal_size().columns
@@ -29,7 +41,29 @@ class Oprinter:  # Could change to inherit from print class instead, but this is
 
     def oprint(self, inp: str, drop_level: int = 0):
         if self.printing_enabled:
-            print(' ' * (self.indent_number - drop_level * self.multiplier) + inp)
+            self.write_lines([' ' * (self.indent_number - drop_level * self.multiplier) + inp])
+
+    def newline(self):
+        if self.printing_enabled:
+            self.write_lines([''])
+
+    @property
+    def buffering(self):
+        return bool(getattr(self.local, 'buffers', None))
+
+    def start_buffering(self):
+        # Output of the current thread is held back until end_buffering, so concurrent work can be printed in order
+        if not hasattr(self.local, 'buffers'): self.local.buffers = []
+        self.local.buffers.append([])
+
+    def end_buffering(self) -> list:
+        return self.local.buffers.pop()
+
+    def write_lines(self, lines: list):
+        if self.buffering:
+            self.local.buffers[-1].extend(lines)
+        else:
+            for line in lines: print(line)
 
 
 class CodecEnum(Flag):
@@ -360,3 +394,4 @@ class TrackDownloadInfo:
     file_url_headers: Optional[dict] = None
     temp_file_path: Optional[str] = None
     different_codec: Optional[CodecEnum] = None
+    manifest: Optional[str] = None  # For DownloadEnum.MPD, the DASH or HLS manifest if already fetched, file_url is its URL
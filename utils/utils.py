@@ -1,9 +1,13 @@
-import pickle, requests, errno, hashlib, math, os, re, operator
-from tqdm import tqdm
-from PIL import Image, ImageChops
+import atexit, copy, logging, pickle, requests, urllib3, errno, hashlib, io, json, math, os, re, operator, threading, time, weakref
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 from functools import reduce
+from urllib.parse import urlparse
+
+from utils.exceptions import DownloadRangeError, DownloadStalledError
 
 
 def hash_string(input_str: str, hash_type: str = 'MD5'):
@@ -12,11 +16,127 @@ def hash_string(input_str: str, hash_type: str = 'MD5'):
     else:
         raise Exception('Invalid hash type selected')
 
+# Set from the "rate_limiting" settings by Orpheus. Rates are in requests per second, 0 means unlimited
+rate_limit_settings = {
+    'requests_per_second': 0,
+    'burst': 5,
+    'max_concurrent_streams': 0,
+    'per_module': {}
+}
+rate_limiters, rate_limiters_lock = {}, threading.Lock()
+rate_limit_context = threading.local()  # Module that requests without a module of their own are made for
+
+class RateLimiter:
+    # Token bucket letting through requests_per_second on average and bursts of up to burst requests. The rate is halved
+    # on every 429 or 503 and raised by a hundredth of the configured rate with every other response (AIMD), so it
+    # settles just under the service's actual limit. A Retry-After pauses every request using the limiter
+    rate_statuses = (429, 503)
+
+    def __init__(self, requests_per_second=0, burst=5, max_concurrent_streams=0):
+        self.max_rate = self.rate = requests_per_second
+        self.burst, self.tokens, self.last_refill = max(burst, 1), max(burst, 1), time.monotonic()
+        self.paused_until, self.lock = 0, threading.Lock()
+        self.streams = threading.BoundedSemaphore(max_concurrent_streams) if max_concurrent_streams else None
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                wait = self.paused_until - now
+                if wait <= 0:
+                    if not self.rate: return
+                    self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+                    self.last_refill = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def update(self, status, headers):
+        with self.lock:
+            if status in self.rate_statuses:
+                try:
+                    retry_after = Retry().parse_retry_after(headers['Retry-After']) if headers.get('Retry-After') else 0
+                except Exception:
+                    retry_after = 0
+                self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+                if self.rate: self.rate = max(self.rate / 2, self.max_rate / 100)
+            elif self.rate:
+                self.rate = min(self.rate + self.max_rate / 100, self.max_rate)
+
+def get_rate_limiter(module_name=None):
+    # The limiter of a module, or of the module set in rate_limit_context, with its settings from per_module
+    module_name = module_name or getattr(rate_limit_context, 'module', None)
+    with rate_limiters_lock:
+        if module_name not in rate_limiters:
+            module_settings = {k: v for k, v in rate_limit_settings.items() if k != 'per_module'}
+            module_settings.update(rate_limit_settings['per_module'].get(module_name, {}) if module_name else {})
+            rate_limiters[module_name] = RateLimiter(**module_settings)
+        return rate_limiters[module_name]
+
+@contextmanager
+def rate_limited_as(module_name):
+    # Requests of sessions not created by a module, like file downloads, count towards module_name's limits
+    previous = getattr(rate_limit_context, 'module', None)
+    rate_limit_context.module = module_name
+    try:
+        yield
+    finally:
+        rate_limit_context.module = previous
+
+class RateLimitedRetry(Retry):
+    # Tells the rate limiter about every response retried, and takes a token from it before retrying
+    module_name = None
+
+    def new(self, **kw):
+        retry = super().new(**kw)
+        retry.module_name = self.module_name
+        return retry
+
+    def sleep(self, response=None):
+        rate_limiter = get_rate_limiter(self.module_name)
+        if response is not None: rate_limiter.update(response.status, response.headers)
+        super().sleep(response)
+        rate_limiter.acquire()
+
+class RateLimitedAdapter(HTTPAdapter):
+    # Takes a token from the rate limiter before every request, and a stream slot for streamed requests, which is given
+    # back once the response is closed or garbage collected
+    def __init__(self, module_name=None, **kwargs):
+        self.module_name = module_name
+        super().__init__(**kwargs)
+
+    def send(self, request, stream=False, **kwargs):
+        rate_limiter = get_rate_limiter(self.module_name)
+        streams = rate_limiter.streams if stream else None
+        if streams: streams.acquire()
+        rate_limiter.acquire()
+        try:
+            response = super().send(request, stream=stream, **kwargs)
+        except BaseException:
+            if streams: streams.release()
+            raise
+        rate_limiter.update(response.status_code, response.headers)
+        if streams:
+            release = weakref.finalize(response, streams.release)
+            close = response.close
+            def close_and_release():
+                try:
+                    close()
+                finally:
+                    release()
+            response.close = close_and_release
+        return response
+
 def create_requests_session():
+    # Sessions created while a module is loaded are rate limited as that module. Others, like r_session, count towards
+    # the module set by rate_limited_as when each request is made
     session_ = requests.Session()
-    retries = Retry(total=10, backoff_factor=0.4, status_forcelist=[429, 500, 502, 503, 504])
-    session_.mount('http://', HTTPAdapter(max_retries=retries))
-    session_.mount('https://', HTTPAdapter(max_retries=retries))
+    retries = RateLimitedRetry(total=10, backoff_factor=0.4, status_forcelist=[429, 500, 502, 503, 504])
+    retries.module_name = getattr(rate_limit_context, 'module', None)
+    session_.mount('http://', RateLimitedAdapter(retries.module_name, max_retries=retries))
+    session_.mount('https://', RateLimitedAdapter(retries.module_name, max_retries=retries))
     return session_
 
 sanitise_name = lambda name : re.sub(r'[:]', ' - ', re.sub(r'[\\/*?"<>|$]', '', re.sub(r'[ \t]+$', '', str(name).rstrip()))) if name else ''
@@ -39,63 +159,328 @@ def fix_byte_limit(path: str, byte_limit=250):
 
 
 r_session = create_requests_session()
+resume_attempts = 5  # How often download_file reconnects from the last received byte before giving up
+
+# Set from the "downloading" settings by Orpheus, so downloads started by modules behave the same
+download_settings = {
+    'segmented_download_threshold': 0,  # In MiB, 0 disables segmented downloads
+    'segmented_download_connections': 4,
+    'download_buffer_size': 256,  # In KiB
+    'segment_connections': 4,  # Segments of DASH and HLS streams fetched at the same time
+    'connect_timeout': 10,  # In seconds
+    'read_timeout': 30,  # In seconds, without receiving anything
+    'stall_speed': 1,  # In KiB/s, 0 disables the minimum speed
+    'stall_time': 60,  # In seconds the speed has to stay below stall_speed
+    'max_host_stalls': 5  # Stalls after which a host's downloads aren't reconnected anymore, 0 for no limit
+}
+host_stalls, host_stalls_lock = defaultdict(deque), threading.Lock()  # Times of stalls, timeouts and dropped connections by host
+host_stall_window = 3600  # Seconds a stall counts towards max_host_stalls
+
+def download_timeout():
+    return download_settings['connect_timeout'] or None, download_settings['read_timeout'] or None
+
+def count_stall(url, error):
+    # Counts a stalled or dropped download for its host. Returns whether it is worth reconnecting, which it isn't
+    # anymore once the host stalled max_host_stalls times in the last host_stall_window seconds of the running jobs, so
+    # a bad server fails its downloads quickly instead of holding up the rest of the batch
+    host, now = urlparse(url).netloc, time.monotonic()
+    with host_stalls_lock:
+        times = host_stalls[host]
+        times.append(now)
+        while times[0] < now - host_stall_window: times.popleft()
+        stalls = len(times)
+    logging.warning(f'Download from {host} interrupted ({stalls} times so far): {error}')
+    return not download_settings['max_host_stalls'] or stalls < download_settings['max_host_stalls']
+
+class SpeedMonitor:
+    # Raises DownloadStalledError when less than stall_speed KiB/s arrived over the last stall_time seconds
+    def __init__(self, url):
+        self.url, self.stall_time = url, download_settings['stall_time']
+        self.min_size = download_settings['stall_speed'] * 1024 * self.stall_time
+        self.window_start, self.window_size = time.monotonic(), 0
+
+    def update(self, size):
+        if not self.min_size: return
+        self.window_size += size
+        now = time.monotonic()
+        if now - self.window_start >= self.stall_time:
+            if self.window_size < self.min_size:
+                raise DownloadStalledError(f'{self.window_size / 1024 / (now - self.window_start):.2f} KiB/s from {urlparse(self.url).netloc}')
+            self.window_start, self.window_size = now, 0
+
+class DownloadProgress:
+    # A tqdm bar that can be shared by every connection of a download, created once the total size is known
+    interval = 0.1  # Seconds between bar updates, the bytes received in between are added up
+
+    def __init__(self, enabled, indent_level=0):
+        self.enabled, self.indent_level, self.bar, self.lock = enabled, indent_level, None, threading.Lock()
+        self.pending, self.last_update = 0, 0
+
+    def start(self, total, downloaded=0):
+        if not self.enabled or not total: return
+        if not self.bar:
+            from tqdm import tqdm  # Imported on first use, like PIL below, to keep startup fast
+            try:
+                columns = os.get_terminal_size().columns
+                if os.name == 'nt':
+                    self.bar = tqdm(total=total, unit='B', unit_scale=True, unit_divisor=1024, initial=0, miniters=1, ncols=(columns-self.indent_level), bar_format=' '*self.indent_level + '{l_bar}{bar}{r_bar}')
+                else:
+                    raise
+            except:
+                self.bar = tqdm(total=total, unit='B', unit_scale=True, unit_divisor=1024, initial=0, miniters=1, bar_format=' '*self.indent_level + '{l_bar}{bar}{r_bar}')
+            # bar.set_description(' '*indent_level)
+        with self.lock:
+            self.bar.total, self.bar.n, self.pending = total, downloaded, 0
+            self.bar.refresh()
+
+    def update(self, size):
+        if not self.bar: return
+        with self.lock:
+            self.pending += size
+            now = time.monotonic()
+            if now - self.last_update >= self.interval:
+                self.bar.update(self.pending)
+                self.pending, self.last_update = 0, now
+
+    def close(self):
+        if self.bar:
+            if self.pending: self.bar.update(self.pending)
+            self.bar.close()
+
+def stream_response(response, f, progress: DownloadProgress, limit=None):
+    # Reads the body into one reusable buffer and writes it to f, yielding the size of every write. Much cheaper per
+    # byte than iter_content's small chunks. limit stops after that many bytes, the response isn't drained. With a
+    # minimum speed, reads return whatever arrived instead of waiting for a full buffer, so a trickle is noticed
+    buffer = memoryview(bytearray(download_settings['download_buffer_size'] * 1024))
+    response.raw.decode_content = True
+    monitor = SpeedMonitor(response.url)
+    read1 = getattr(response.raw, 'read1', None) if monitor.min_size else None  # Only in newer urllib3 versions
+    while limit is None or limit > 0:
+        try:
+            if read1:
+                data = read1(len(buffer) if limit is None else min(limit, len(buffer)))
+                size = len(data)
+            else:
+                size = response.raw.readinto(buffer if limit is None or limit >= len(buffer) else buffer[:limit])
+        except urllib3.exceptions.ProtocolError as e:  # Same exceptions as iter_content raises
+            raise requests.exceptions.ChunkedEncodingError(e)
+        except urllib3.exceptions.ReadTimeoutError as e:
+            raise requests.exceptions.ConnectionError(e)
+        if not size: break
+        f.write(data if read1 else buffer[:size])
+        progress.update(size)
+        if limit is not None: limit -= size
+        yield size
+        monitor.update(size)  # After the caller counted the bytes written, so a reconnect resumes after them
+
+def get_content_range_total(response):
+    # "Content-Range: bytes 0-99/1234" gives 1234, None if the server didn't send a usable range
+    match = re.fullmatch(r'bytes \d+-\d+/(\d+)', response.headers.get('content-range', ''))
+    return int(match.group(1)) if match else None
+
+def save_download_state(state_location, state: dict):
+    with open(state_location, 'w') as f:
+        json.dump(state, f)
+
+def download_segments(url, headers, part_location, state_location, state: dict, progress: DownloadProgress, first_response=None):
+    # Fetches the byte ranges in state['segments'] ([start, end, bytes done]) in parallel, writing them into a
+    # preallocated part file at their offsets. The progress of every segment is saved, so they resume individually
+    total, segments, lock = state['total'], state['segments'], threading.Lock()
+    if not os.path.isfile(part_location) or os.path.getsize(part_location) != total:
+        with open(part_location, 'wb') as f: f.truncate(total)
+    progress.start(total, sum(segment[2] for segment in segments))
+
+    def fetch_segment(segment, response=None):
+        start, end = segment[0], segment[1]
+        for attempt in range(1, resume_attempts + 1):
+            if start + segment[2] > end: return
+            if response is None:
+                response = r_session.get(url, stream=True, headers={**headers, 'Range': f'bytes={start + segment[2]}-{end}'},
+                    verify=False, timeout=download_timeout())
+                if response.status_code != 206 or get_content_range_total(response) != total:
+                    response.close()
+                    raise DownloadRangeError(f'Server stopped serving byte ranges of {total} bytes')
+
+            with response, open(part_location, 'r+b') as f:
+                f.seek(start + segment[2])
+                try:
+                    # The first response is not limited to the segment, so stop at its end
+                    for size in stream_response(response, f, progress, end + 1 - start - segment[2]):
+                        segment[2] += size
+                except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError, DownloadStalledError) as e:
+                    if not count_stall(url, e) or attempt == resume_attempts: raise
+                finally:
+                    with lock: save_download_state(state_location, state)
+            response = None
+        if start + segment[2] <= end:
+            raise Exception(f'Download incomplete, segment {start}-{end} is missing {end + 1 - start - segment[2]} bytes')
+
+    with ThreadPoolExecutor(max_workers=len(segments)) as executor:
+        futures = [executor.submit(fetch_segment, segment, first_response if i == 0 else None) for i, segment in enumerate(segments)]
+        for future in futures: future.result()
 
 def download_file(url, file_location, headers={}, enable_progress_bar=False, indent_level=0, artwork_settings=None):
     if os.path.isfile(file_location):
         return None
 
-    r = r_session.get(url, stream=True, headers=headers, verify=False)
+    # Downloads go to a .part file that is only renamed once it is complete. Its expected size is stored next to it,
+    # so an interrupted download resumes with a Range request, both within this call and on the next run
+    part_location, state_location = file_location + '.part', file_location + '.part.json'
+    try:
+        with open(state_location, 'r') as f:
+            state = json.load(f) if os.path.isfile(part_location) else {}
+    except (OSError, ValueError):
+        state = {}
+    total = state.get('total')
+    downloaded = os.path.getsize(part_location) if total and not state.get('segments') else 0
 
-    total = None
-    if 'content-length' in r.headers:
-        total = int(r.headers['content-length'])
+    # Large files are split into byte ranges fetched over several connections, if the server supports it
+    segmented_threshold = download_settings['segmented_download_threshold'] * 1024**2
+    connections = download_settings['segmented_download_connections']
 
+    progress = DownloadProgress(enable_progress_bar, indent_level)
     try:
-        with open(file_location, 'wb') as f:
-            if enable_progress_bar and total:
+        if state.get('segments'):
+            try:
+                download_segments(url, headers, part_location, state_location, state, progress)
+                downloaded = total
+            except DownloadRangeError:
+                total, segmented_threshold = None, 0  # Start over with a single stream below
+
+        for attempt in range(1, resume_attempts + 1):
+            if total and downloaded == total: break
+            request_headers = {**headers, 'Range': f'bytes={downloaded}-'} if downloaded else headers
+            with r_session.get(url, stream=True, headers=request_headers, verify=False, timeout=download_timeout()) as r:
+                if downloaded and r.status_code == 416:
+                    if downloaded == total: break  # The part file is already complete
+                    downloaded = 0
+                    continue
+
+                if not downloaded or r.status_code != 206 or get_content_range_total(r) != total:
+                    # First request, or the server ignored the range or serves a different file now, so start over
+                    downloaded = 0
+                    total = int(r.headers['content-length']) if 'content-length' in r.headers else None
+                    if total and 'bytes' in r.headers.get('accept-ranges', ''):
+                        if segmented_threshold and total >= segmented_threshold and connections > 1 and r.status_code == 200:
+                            size = -(-total // connections)
+                            state = {'url': url, 'total': total, 'segments': [[i, min(i + size, total) - 1, 0] for i in range(0, total, size)]}
+                            save_download_state(state_location, state)
+                            try:
+                                download_segments(url, headers, part_location, state_location, state, progress, first_response=r)
+                                downloaded = total
+                                break
+                            except DownloadRangeError:
+                                downloaded, segmented_threshold = 0, 0
+                                continue
+                        save_download_state(state_location, {'url': url, 'total': total})
+
+                progress.start(total, downloaded)
+
                 try:
-                    columns = os.get_terminal_size().columns
-                    if os.name == 'nt':
-                        bar = tqdm(total=total, unit='B', unit_scale=True, unit_divisor=1024, initial=0, miniters=1, ncols=(columns-indent_level), bar_format=' '*indent_level + '{l_bar}{bar}{r_bar}')
-                    else:
-                        raise
-                except:
-                    bar = tqdm(total=total, unit='B', unit_scale=True, unit_divisor=1024, initial=0, miniters=1, bar_format=' '*indent_level + '{l_bar}{bar}{r_bar}')
-                # bar.set_description(' '*indent_level)
-                for chunk in r.iter_content(chunk_size=1024):
-                    if chunk:  # filter out keep-alive new chunks
-                        f.write(chunk)
-                        bar.update(len(chunk))
-                bar.close()
-            else:
-                [f.write(chunk) for chunk in r.iter_content(chunk_size=1024) if chunk]
+                    with open(part_location, 'ab' if downloaded else 'wb') as f:
+                        for size in stream_response(r, f, progress):
+                            downloaded += size
+                except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError, DownloadStalledError) as e:
+                    if not count_stall(url, e) or attempt == resume_attempts or not os.path.isfile(state_location): raise
+
+            if not total or downloaded >= total:
+                break
+        if total and downloaded != total:
+            raise Exception(f'Download incomplete, got {downloaded} of {total} bytes')
+
         if artwork_settings and artwork_settings.get('should_resize', False):
-            new_resolution = artwork_settings.get('resolution', 1400)
-            new_format = artwork_settings.get('format', 'jpeg')
-            if new_format == 'jpg': new_format = 'jpeg'
-            new_compression = artwork_settings.get('compression', 'low')
-            if new_compression == 'low':
-                new_compression = 90
-            elif new_compression == 'high':
-                new_compression = 70
-            if new_format == 'png': new_compression = None
-            with Image.open(file_location) as im:
-                im = im.resize((new_resolution, new_resolution), Image.Resampling.BICUBIC)
-                im.save(file_location, new_format, quality=new_compression)
-    except KeyboardInterrupt:
-        if os.path.isfile(file_location):
-            print(f'\tDeleting partially downloaded file "{str(file_location)}"')
-            silentremove(file_location)
-        raise KeyboardInterrupt
+            with open(part_location, 'rb') as f:
+                data = resize_artwork(f.read(), artwork_settings)
+            with open(part_location, 'wb') as f:
+                f.write(data)
+
+        os.replace(part_location, file_location)
+        silentremove(state_location)
+    finally:
+        progress.close()
+
+def download_to_ffmpeg(url, file_location, output_options: dict, headers={}, enable_progress_bar=False, indent_level=0):
+    # Feeds a download to ffmpeg's stdin, which writes the converted file, so the original never touches the disk. A
+    # dropped connection is resumed with a Range request like in download_file, into the same ffmpeg process. ffmpeg
+    # writes a file rather than to stdout, as containers like FLAC and MP4 seek back to finish their headers
+    import ffmpeg  # Imported on first use, like in the Downloader
+    root, extension = os.path.splitext(file_location)
+    part_location = f'{root}.part{extension}'
+    process = ffmpeg.input('pipe:').output(part_location, **output_options, loglevel='error').overwrite_output() \
+        .run_async(pipe_stdin=True, pipe_stderr=True)
+    ffmpeg_error = lambda: Exception(f'ffmpeg error converting to {extension[1:]}:\n{process.stderr.read().decode("utf-8")}')
+
+    progress = DownloadProgress(enable_progress_bar, indent_level)
+    downloaded, total = 0, None
+    try:
+        for attempt in range(1, resume_attempts + 1):
+            request_headers = {**headers, 'Range': f'bytes={downloaded}-'} if downloaded else headers
+            with r_session.get(url, stream=True, headers=request_headers, verify=False, timeout=download_timeout()) as r:
+                r.raise_for_status()
+                if not downloaded:
+                    total = int(r.headers['content-length']) if 'content-length' in r.headers else None
+                    progress.start(total)
+                elif r.status_code != 206 or get_content_range_total(r) != total:
+                    raise Exception('Download interrupted and the server does not support resuming it')
+                try:
+                    for size in stream_response(r, process.stdin, progress):
+                        downloaded += size
+                except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError, DownloadStalledError) as e:
+                    if not total or not count_stall(url, e) or attempt == resume_attempts: raise
+                except BrokenPipeError:  # ffmpeg stopped reading
+                    raise ffmpeg_error()
+            if not total or downloaded >= total:
+                break
+        if total and downloaded != total:
+            raise Exception(f'Download incomplete, got {downloaded} of {total} bytes')
+
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+        if process.wait():
+            raise ffmpeg_error()
+        os.replace(part_location, file_location)
+    except BaseException:
+        process.kill()
+        process.wait()
+        silentremove(part_location)
+        raise
+    finally:
+        progress.close()
+
+def resize_artwork(data: bytes, artwork_settings: dict) -> bytes:
+    # Resizes and re-encodes an image in memory. Module level so it can also run in a process pool
+    new_resolution = artwork_settings.get('resolution', 1400)
+    new_format = artwork_settings.get('format', 'jpeg')
+    if new_format == 'jpg': new_format = 'jpeg'
+    new_compression = artwork_settings.get('compression', 'low')
+    if new_compression == 'low':
+        new_compression = 90
+    elif new_compression == 'high':
+        new_compression = 70
+    if new_format == 'png': new_compression = None
+    from PIL import Image
+    with Image.open(io.BytesIO(data)) as im:
+        # JPEGs are decoded at the smallest 1/2, 1/4 or 1/8 scale still above the target size, which is much cheaper
+        # than a full decode. Other formats are shrunk by an integer factor with reduce() first
+        im.draft(im.mode, (new_resolution, new_resolution))
+        im = im.resize((new_resolution, new_resolution), Image.Resampling.BICUBIC, reducing_gap=3.0)
+        output = io.BytesIO()
+        im.save(output, new_format, quality=new_compression)
+        return output.getvalue()
 
 # root mean square code by Charlie Clark: https://code.activestate.com/recipes/577630-comparing-two-images/
 def compare_images(image_1, image_2):
+    from PIL import Image, ImageChops
     with Image.open(image_1) as im1, Image.open(image_2) as im2:
         h = ImageChops.difference(im1, im2).convert('L').histogram()
         return math.sqrt(reduce(operator.add, map(lambda h, i: h*(i**2), h, range(256))) / (float(im1.size[0]) * im1.size[1]))
 
-# TODO: check if not closing the files causes issues, and see if there's a way to use the context manager with lambda expressions
-get_image_resolution = lambda image_location : Image.open(image_location).size[0]
+def get_image_resolution(image_location):
+    from PIL import Image
+    with Image.open(image_location) as im:
+        return im.size[0]
 
 def silentremove(filename):
     try:
@@ -104,47 +489,130 @@ def silentremove(filename):
         if e.errno != errno.ENOENT:
             raise
 
-def read_temporary_setting(settings_location, module, root_setting=None, setting=None, global_mode=False):
-    temporary_settings = pickle.load(open(settings_location, 'rb'))
-    module_settings = temporary_settings['modules'][module] if module in temporary_settings['modules'] else None
-    
-    if module_settings:
-        if global_mode:
-            session = module_settings
+@contextmanager
+def file_lock(lock_location, exclusive=True):
+    # Advisory lock shared by every process using the same lock file. Windows only has exclusive locks
+    with open(lock_location, 'a+b') as f:
+        if os.name == 'nt':
+            import msvcrt
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:  # LK_LOCK gives up after 10 seconds
+                    pass
         else:
-            session = module_settings['sessions'][module_settings['selected']]
-    else:
-        session = None
+            import fcntl
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            if os.name == 'nt':
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+class SessionStore:
+    # loginstorage.bin, loaded once per process and reloaded only when another process replaced it. Changes are made
+    # in memory and written back together shortly after (and at exit), merged into the current file under a file lock
+    # and atomically replacing it, so several processes can share sessions without losing each other's changes
+    write_delay = 1  # Seconds
+
+    def __init__(self, location):
+        self.location, self.lock_location, self.lock = location, location + '.lock', threading.RLock()
+        self.data, self.signature, self.pending, self.timer = None, None, [], None
+        atexit.register(self.flush)
+
+    def _signature(self):
+        try:
+            stat = os.stat(self.location)
+            return stat.st_mtime_ns, stat.st_size
+        except FileNotFoundError:
+            return None
+
+    def _read(self):
+        with open(self.location, 'rb') as f:
+            return pickle.load(f)
 
+    def _write(self, data):
+        with open(self.location + '.tmp', 'wb') as f:
+            pickle.dump(data, f)
+        os.replace(self.location + '.tmp', self.location)
+        self.signature = self._signature()
+
+    def get(self):
+        with self.lock:
+            if self.data is None or self._signature() != self.signature:
+                with file_lock(self.lock_location, exclusive=False):
+                    self.data, self.signature = self._read(), self._signature()
+                for change in self.pending: apply_temporary_setting(self.data, *change)
+            return self.data
+
+    def set(self, *change):
+        with self.lock:
+            apply_temporary_setting(self.get(), *change)
+            self.pending.append(change)
+            if not self.timer:
+                self.timer = threading.Timer(self.write_delay, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            if self.timer: self.timer.cancel()
+            self.timer = None
+            if not self.pending: return
+            with file_lock(self.lock_location):
+                data = self._read()
+                for change in self.pending: apply_temporary_setting(data, *change)
+                self._write(data)
+            self.data, self.pending = data, []
+
+    def replace(self, data):
+        with self.lock, file_lock(self.lock_location):
+            self._write(data)
+            self.data, self.pending = data, []
+
+session_stores, session_stores_lock = {}, threading.Lock()
+
+def get_session_store(settings_location) -> SessionStore:
+    with session_stores_lock:
+        if settings_location not in session_stores:
+            session_stores[settings_location] = SessionStore(settings_location)
+        return session_stores[settings_location]
+
+def get_temporary_session(temporary_settings, module, global_mode=False):
+    module_settings = temporary_settings['modules'][module] if module in temporary_settings['modules'] else None
+    if not module_settings:
+        return None
+    return module_settings if global_mode else module_settings['sessions'][module_settings['selected']]
+
+def read_temporary_setting(settings_location, module, root_setting=None, setting=None, global_mode=False):
+    session = get_temporary_session(get_session_store(settings_location).get(), module, global_mode)
+
+    # Copies, as changing what's returned used to have no effect on the stored settings
     if session and root_setting:
         if setting:
-            return session[root_setting][setting] if root_setting in session and setting in session[root_setting] else None
+            return copy.deepcopy(session[root_setting][setting]) if root_setting in session and setting in session[root_setting] else None
         else:
-            return session[root_setting] if root_setting in session else None
+            return copy.deepcopy(session[root_setting]) if root_setting in session else None
     elif root_setting and not session:
         raise Exception('Module does not use temporary settings') 
     else:
-        return session
-
-def set_temporary_setting(settings_location, module, root_setting, setting=None, value=None, global_mode=False):
-    temporary_settings = pickle.load(open(settings_location, 'rb'))
-    module_settings = temporary_settings['modules'][module] if module in temporary_settings['modules'] else None
-
-    if module_settings:
-        if global_mode:
-            session = module_settings
-        else:
-            session = module_settings['sessions'][module_settings['selected']]
-    else:
-        session = None
+        return copy.deepcopy(session)
 
+def apply_temporary_setting(temporary_settings, module, root_setting, setting=None, value=None, global_mode=False):
+    session = get_temporary_session(temporary_settings, module, global_mode)
     if not session:
         raise Exception('Module does not use temporary settings')
     if setting:
-        session[root_setting][setting] = value
+        session[root_setting][setting] = copy.deepcopy(value)
     else:
-        session[root_setting] = value
-    pickle.dump(temporary_settings, open(settings_location, 'wb'))
+        session[root_setting] = copy.deepcopy(value)
+
+def set_temporary_setting(settings_location, module, root_setting, setting=None, value=None, global_mode=False):
+    get_session_store(settings_location).set(module, root_setting, setting, value, global_mode)
 
 create_temp_filename = lambda : f'temp/{os.urandom(16).hex()}'
 